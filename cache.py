@@ -0,0 +1,185 @@
+import numpy as np
+import collections
+import threading
+import hashlib
+import json
+import time
+import os
+from utils import Struct
+
+
+def checkpoint_id(checkpoint):
+    ''' Content hash of a checkpoint (its .index holds a checksum of every tensor) or of a generator export,
+        unique across model directories.
+    '''
+    filename = checkpoint if checkpoint.endswith(".npz") else "{}.index".format(checkpoint)
+    content_hash = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+class GenerationCache(object):
+    ''' Content-addressed cache of generated images (PNG bytes).
+        Keys hash the checkpoint id, the generator settings (truncation, noise mode, data format, resolution)
+        and the request (seed, mixing seed and crossover depth).
+        An LRU tier in memory sits in front of a size-bounded tier on disk (evicted by last access),
+        which other processes can share (files may disappear at any time).
+    '''
+
+    def __init__(self, render_fn, checkpoint_id, settings, capacity=1024, cache_dir=None, max_bytes=1 << 30):
+        self.render_fn = render_fn
+        self.checkpoint_id = checkpoint_id
+        self.settings = settings
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.latencies = collections.Counter()
+        self.disk_bytes = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, size, _ in self.disk_entries())
+
+    def key(self, request):
+        return hashlib.sha256(json.dumps(dict(
+            checkpoint_id=self.checkpoint_id,
+            settings=self.settings,
+            request=request
+        ), sort_keys=True).encode()).hexdigest()
+
+    def disk_files(self):
+        return [
+            os.path.join(self.cache_dir, filename)
+            for filename in os.listdir(self.cache_dir) if filename.endswith(".png")
+        ]
+
+    def disk_entries(self):
+        ''' (modification time, size, filename) of the files on disk which still exist. '''
+        entries = []
+        for filename in self.disk_files():
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def disk_filename(self, key):
+        return os.path.join(self.cache_dir, "{}.png".format(key))
+
+    def remember(self, key, image):
+        self.memory[key] = image
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def lookup(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return "memory", self.memory[key]
+        if self.cache_dir:
+            try:
+                # access time for eviction is tracked through the modification time
+                os.utime(self.disk_filename(key))
+                with open(self.disk_filename(key), "rb") as file:
+                    image = file.read()
+            except FileNotFoundError:
+                return "miss", None
+            self.remember(key, image)
+            return "disk", image
+        return "miss", None
+
+    def store(self, key, image):
+        self.remember(key, image)
+        if not self.cache_dir:
+            return
+        # concurrent misses of the same key are rendered and stored more than once
+        try:
+            self.disk_bytes -= os.path.getsize(self.disk_filename(key))
+        except FileNotFoundError:
+            pass
+        with open("{}.tmp".format(self.disk_filename(key)), "wb") as file:
+            file.write(image)
+        os.replace(file.name, self.disk_filename(key))
+        self.disk_bytes += len(image)
+        if self.disk_bytes > self.max_bytes:
+            for _, size, filename in sorted(self.disk_entries()):
+                # gone either way if another process evicted it first
+                self.disk_bytes -= size
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+                if self.disk_bytes <= self.max_bytes * 0.9:
+                    break
+
+    def get(self, requests):
+        ''' Returns PNG bytes for every request, misses are rendered together in one batch. '''
+        begin = time.perf_counter()
+        with self.lock:
+            keys = [self.key(request) for request in requests]
+            results = [self.lookup(key) for key in keys]
+            for tier, _ in results:
+                self.counts[tier] += 1
+            self.latencies["lookup"] += time.perf_counter() - begin
+
+        misses = [i for i, (tier, _) in enumerate(results) if tier == "miss"]
+        images = [image for _, image in results]
+        if misses:
+            begin = time.perf_counter()
+            for i, image in zip(misses, self.render_fn([requests[i] for i in misses])):
+                images[i] = image
+            with self.lock:
+                self.latencies["render"] += time.perf_counter() - begin
+                for i in misses:
+                    self.store(keys[i], images[i])
+
+        return images
+
+    def metrics(self):
+        with self.lock:
+            num_requests = sum(self.counts.values())
+            return Struct(
+                num_requests=num_requests,
+                memory_hit_rate=self.counts["memory"] / max(num_requests, 1),
+                disk_hit_rate=self.counts["disk"] / max(num_requests, 1),
+                hit_rate=(self.counts["memory"] + self.counts["disk"]) / max(num_requests, 1),
+                mean_lookup_latency=self.latencies["lookup"] / max(num_requests, 1),
+                mean_render_latency=self.latencies["render"] / max(self.counts["miss"], 1),
+                memory_entries=len(self.memory),
+                disk_bytes=self.disk_bytes
+            )
+
+
+def renderer_fn(renderer, session, batch_size, latent_size=512):
+    ''' Renders requests Struct(seed, mixing_seed, crossover_depth) with a Renderer.
+        Latents are drawn from the seeds and the seed doubles as sample id for seeded noise.
+    '''
+    def latents(seed):
+        return np.random.RandomState(seed).normal(size=[latent_size])
+
+    def render(requests):
+        high_latents = renderer.map(session, [latents(request["seed"]) for request in requests], batch_size)
+        low_latents = renderer.map(session, [
+            latents(request["seed"] if request.get("mixing_seed") is None else request["mixing_seed"])
+            for request in requests
+        ], batch_size)
+        switching_depths = [
+            renderer.max_depth + 1 if request.get("mixing_seed") is None else request["crossover_depth"]
+            for request in requests
+        ]
+        images = renderer.synthesize(
+            session=session,
+            high_latents=high_latents,
+            low_latents=low_latents,
+            switching_depths=switching_depths,
+            batch_size=batch_size,
+            sample_ids=[request["seed"] for request in requests]
+        )
+        return [renderer.encode_png(session, image) for batch in images for image in batch]
+
+    return render
@@ -1,11 +1,111 @@
 import tensorflow as tf
 import numpy as np
 import pickle
+import functools
+import time
 import os
 from utils import Struct
 
+# raw uint8 store: magic followed by [num_examples, channels, height, width]
+# then all images (NCHW) then all labels
+MEMMAP_MAGIC = b"UINT8MAP"
+MEMMAP_HEADER = np.dtype([("magic", "S8"), ("shape", "<u8", 4)])
 
-def cifar10_input_fn(filenames, batch_size, num_epochs, shuffle):
+# default shuffle buffer size (in images) when decoded images are cached
+CACHED_SHUFFLE_BUFFER_SIZE = 10000
+
+
+def write_memmap(filename, images, labels):
+    # written to a temporary file first so that concurrent processes never see a partial store
+    header = np.array((MEMMAP_MAGIC, images.shape), dtype=MEMMAP_HEADER)
+    with open("{}.{}.tmp".format(filename, os.getpid()), "wb") as file:
+        file.write(header.tobytes())
+        file.write(np.ascontiguousarray(images, dtype=np.uint8).tobytes())
+        file.write(np.ascontiguousarray(labels, dtype=np.uint8).tobytes())
+    os.replace(file.name, filename)
+
+
+def allocate_memmap(filename, shape):
+    # a zero-filled store (labels included) whose images are filled in place through the returned memory map
+    header = np.array((MEMMAP_MAGIC, shape), dtype=MEMMAP_HEADER)
+    with open(filename, "wb") as file:
+        file.write(header.tobytes())
+        file.truncate(MEMMAP_HEADER.itemsize + np.prod(shape) + shape[0])
+    return np.memmap(
+        filename=filename,
+        dtype=np.uint8,
+        mode="r+",
+        offset=MEMMAP_HEADER.itemsize,
+        shape=tuple(shape)
+    )
+
+
+def read_memmap(filename):
+    # read-only memory maps share the page cache between processes
+    header = np.fromfile(filename, dtype=MEMMAP_HEADER, count=1)[0]
+    if header["magic"] != MEMMAP_MAGIC:
+        raise ValueError("{} is not a uint8 memmap store".format(filename))
+    shape = tuple(map(int, header["shape"]))
+    images = np.memmap(
+        filename=filename,
+        dtype=np.uint8,
+        mode="r",
+        offset=MEMMAP_HEADER.itemsize,
+        shape=shape
+    )
+    labels = np.memmap(
+        filename=filename,
+        dtype=np.uint8,
+        mode="r",
+        offset=MEMMAP_HEADER.itemsize + images.nbytes,
+        shape=shape[:1]
+    )
+    return images, labels
+
+
+def memmap_dataset(filename, batch_size, num_epochs, shuffle):
+    ''' Streams batches of (images, labels) from a uint8 memmap store.
+        Only indices go through the shuffle buffer, images are sliced out of the page cache per batch.
+    '''
+    images, labels = read_memmap(filename)
+
+    def gather(indices):
+        indices = np.sort(indices)
+        return images[indices], labels[indices]
+
+    def load(indices):
+        batch_images, batch_labels = tf.py_func(
+            func=gather,
+            inp=[indices],
+            Tout=[tf.uint8, tf.uint8],
+            stateful=False
+        )
+        batch_images.set_shape([None, *images.shape[1:]])
+        batch_labels.set_shape([None])
+        return batch_images, batch_labels
+
+    dataset = tf.data.Dataset.range(len(images))
+    if shuffle:
+        dataset = dataset.shuffle(
+            buffer_size=len(images),
+            reshuffle_each_iteration=True
+        )
+    dataset = dataset.repeat(count=num_epochs)
+    dataset = dataset.batch(
+        batch_size=batch_size,
+        drop_remainder=True
+    )
+    dataset = dataset.map(load)
+
+    return dataset
+
+
+def cifar10_input_fn(filenames, batch_size, num_epochs, shuffle,
+                     num_parallel_calls=None, prefetch_buffer_size=1, memmap_filename=None, saveable=False):
+
+    # iterators over py_func datasets can not be serialized
+    if saveable and memmap_filename is not None:
+        raise ValueError("memmap input pipelines are not saveable")
 
     def unpickle(file):
         with open(file, "rb") as file:
@@ -27,33 +127,141 @@ def cifar10_input_fn(filenames, batch_size, num_epochs, shuffle):
 
         return images, labels
 
-    dicts = [unpickle(filename) for filename in filenames]
-    images = np.concatenate([dict[b"data"] for dict in dicts])
-    labels = np.concatenate([dict[b"labels"] for dict in dicts])
+    def convert(filenames):
+        dicts = [unpickle(filename) for filename in filenames]
+        images = np.concatenate([dict[b"data"] for dict in dicts])
+        labels = np.concatenate([dict[b"labels"] for dict in dicts])
+        return images, labels
 
-    dataset = tf.data.Dataset.from_tensor_slices((images, labels))
-    if shuffle:
-        dataset = dataset.shuffle(
-            buffer_size=len(images),
-            reshuffle_each_iteration=True
+    if memmap_filename is not None:
+        # one-time conversion, later runs stream from the store
+        if not os.path.exists(memmap_filename):
+            images, labels = convert(filenames)
+            write_memmap(memmap_filename, images.reshape(-1, 3, 32, 32), labels)
+        dataset = memmap_dataset(memmap_filename, batch_size, num_epochs, shuffle)
+    else:
+        images, labels = convert(filenames)
+        dataset = tf.data.Dataset.from_tensor_slices((images, labels))
+        if shuffle:
+            dataset = dataset.shuffle(
+                buffer_size=len(images),
+                reshuffle_each_iteration=True
+            )
+        dataset = dataset.repeat(count=num_epochs)
+        dataset = dataset.batch(
+            batch_size=batch_size,
+            drop_remainder=True
         )
-    dataset = dataset.repeat(count=num_epochs)
-    dataset = dataset.batch(
-        batch_size=batch_size,
-        drop_remainder=True
-    )
     dataset = dataset.map(
         map_func=preprocess,
-        num_parallel_calls=os.cpu_count()
+        num_parallel_calls=num_parallel_calls or os.cpu_count()
     )
-    dataset = dataset.prefetch(buffer_size=1)
+    dataset = dataset.prefetch(buffer_size=prefetch_buffer_size)
 
     iterator = dataset.make_one_shot_iterator()
+    if saveable:
+        add_saveable_iterator(iterator)
 
     return iterator.get_next()
 
 
-def celeba_input_fn(filenames, batch_size, num_epochs, shuffle, image_size):
+def add_saveable_iterator(iterator):
+    ''' Checkpoints the iterator state (epoch position and shuffle buffer) with the model.
+        Saveable objects can't be exported to a MetaGraph, so the iterator resource is also collected
+        in "saveable_iterators" for reattach_saveable_iterators after an import.
+    '''
+    saveable = tf.data.experimental.make_saveable_from_iterator(iterator)
+    tf.add_to_collection(tf.GraphKeys.SAVEABLE_OBJECTS, saveable)
+    tf.add_to_collection("saveable_iterators", saveable.op)
+
+
+def reattach_saveable_iterators():
+    ''' Adds the iterators of an imported MetaGraph back to SAVEABLE_OBJECTS (under their original names). '''
+    for iterator_resource in tf.get_collection("saveable_iterators"):
+        # the saveable only uses the resource, the element structure is irrelevant
+        iterator = tf.data.Iterator(iterator_resource, None, tf.float32, tf.TensorShape(None), tf.Tensor)
+        tf.add_to_collection(tf.GraphKeys.SAVEABLE_OBJECTS, tf.data.experimental.make_saveable_from_iterator(iterator))
+
+
+def count_records(filename):
+    ''' Number of records in a TFRecord file, persisted next to it so that restarts don't re-scan. '''
+    count_filename = "{}.num_records".format(filename)
+    if os.path.exists(count_filename) and os.path.getmtime(count_filename) >= os.path.getmtime(filename):
+        with open(count_filename) as file:
+            return int(file.read())
+    count = sum(1 for _ in tf.io.tf_record_iterator(filename))
+    try:
+        with open("{}.{}.tmp".format(count_filename, os.getpid()), "w") as file:
+            file.write(str(count))
+        os.replace(file.name, count_filename)
+    except OSError:
+        # read-only dataset directory, the count is just not persisted
+        pass
+    return count
+
+
+def convert_celeba(filenames, image_size, memmap_filename, batch_size=256, num_parallel_calls=None, config=None):
+    ''' Decodes and resizes every image once into a uint8 memmap store,
+        e.g. in /dev/shm to share one pre-decoded copy between concurrent training processes.
+        Batches are written straight into the store, so the dataset is never held in memory.
+    '''
+    def decode(example):
+
+        features = Struct(tf.parse_single_example(
+            serialized=example,
+            features=dict(path=tf.FixedLenFeature([], dtype=tf.string))
+        ))
+
+        image = tf.read_file(features.path)
+        image = tf.image.decode_jpeg(image, 3)
+        image = tf.image.convert_image_dtype(image, tf.float32)
+        image = tf.image.resize_images(image, image_size)
+        image = tf.image.convert_image_dtype(image, tf.uint8, saturate=True)
+        image = tf.transpose(image, [2, 0, 1])
+
+        return image
+
+    with tf.Graph().as_default():
+
+        dataset = tf.data.TFRecordDataset(filenames)
+        dataset = dataset.map(
+            map_func=decode,
+            num_parallel_calls=num_parallel_calls or os.cpu_count()
+        )
+        dataset = dataset.batch(batch_size=batch_size)
+        dataset = dataset.prefetch(buffer_size=1)
+
+        images = dataset.make_one_shot_iterator().get_next()
+
+        # written to a temporary file first so that concurrent processes never see a partial store
+        num_images = sum(map(count_records, filenames))
+        store = allocate_memmap("{}.{}.tmp".format(memmap_filename, os.getpid()), [num_images, 3, *image_size])
+
+        with tf.Session(config=config) as session:
+            begin = 0
+            while True:
+                try:
+                    batch = session.run(images)
+                except tf.errors.OutOfRangeError:
+                    break
+                store[begin:begin + len(batch)] = batch
+                begin += len(batch)
+
+    store.flush()
+    os.replace(store.filename, memmap_filename)
+
+
+def celeba_input_fn(filenames, batch_size, num_epochs, shuffle, image_size,
+                    num_parallel_calls=None, num_parallel_reads=None, prefetch_buffer_size=1,
+                    batch_then_decode=False, cache=None, shuffle_buffer_size=None, saveable=False,
+                    memmap_filename=None):
+
+    # iterators over py_func datasets can not be serialized
+    if saveable and memmap_filename is not None:
+        raise ValueError("memmap input pipelines are not saveable")
+    # the iterator state would contain the decoded shuffle buffer (and an in-memory cache)
+    if saveable and cache is not None:
+        raise ValueError("cached input pipelines are not saveable")
 
     def parse_example(example):
 
@@ -67,40 +275,161 @@ def celeba_input_fn(filenames, batch_size, num_epochs, shuffle, image_size):
 
         return image
 
+    def parse_examples(examples):
+
+        features = Struct(tf.parse_example(
+            serialized=examples,
+            features=dict(path=tf.FixedLenFeature([], dtype=tf.string))
+        ))
+
+        # one vectorized parse per batch, decoding in parallel within the batch
+        images = tf.map_fn(
+            fn=lambda path: resize(tf.image.decode_jpeg(tf.read_file(path), 3)),
+            elems=features.path,
+            dtype=tf.uint8,
+            parallel_iterations=batch_size
+        )
+
+        return images
+
+    def resize(image):
+
+        image = tf.image.convert_image_dtype(image, tf.float32)
+        image = tf.image.resize_images(image, image_size)
+        image = tf.image.convert_image_dtype(image, tf.uint8, saturate=True)
+
+        return image
+
     def preprocess(images):
 
         def normalize(inputs, mean, std):
             return (inputs - mean) / std
 
         images = tf.image.convert_image_dtype(images, tf.float32)
-        images = tf.image.resize_images(images, image_size)
+        if not resized:
+            images = tf.image.resize_images(images, image_size)
         images = tf.image.random_flip_left_right(images)
         images = tf.transpose(images, [0, 3, 1, 2])
         images = normalize(images, 0.5, 0.5)
 
         return images
 
-    dataset = tf.data.TFRecordDataset(filenames)
-    if shuffle:
-        dataset = dataset.shuffle(
-            buffer_size=sum([
-                len(list(tf.io.tf_record_iterator(filename)))
-                for filename in filenames
-            ]),
-            reshuffle_each_iteration=True
-        )
-    dataset = dataset.repeat(count=num_epochs)
-    dataset = dataset.map(
-        map_func=parse_example,
-        num_parallel_calls=os.cpu_count()
-    )
-    dataset = dataset.batch(batch_size=batch_size)
+    num_parallel_calls = num_parallel_calls or os.cpu_count()
+    resized = batch_then_decode or cache is not None or memmap_filename is not None
+
+    if memmap_filename is not None:
+        # one-time conversion, later runs (and concurrent ones) stream from the store
+        if not os.path.exists(memmap_filename):
+            convert_celeba(filenames, image_size, memmap_filename, num_parallel_calls=num_parallel_calls)
+        if list(read_memmap(memmap_filename)[0].shape[2:]) != list(image_size):
+            raise ValueError("{} doesn't hold {} images".format(memmap_filename, image_size))
+        dataset = memmap_dataset(memmap_filename, batch_size, num_epochs, shuffle)
+        dataset = dataset.map(lambda images, labels: tf.transpose(images, [0, 2, 3, 1]))
+    else:
+        if num_parallel_reads:
+            # interleaved reads over the record files
+            dataset = tf.data.Dataset.from_tensor_slices(filenames)
+            dataset = dataset.interleave(
+                map_func=tf.data.TFRecordDataset,
+                cycle_length=len(filenames),
+                block_length=1,
+                num_parallel_calls=num_parallel_reads
+            )
+        else:
+            dataset = tf.data.TFRecordDataset(filenames)
+
+        if cache is not None:
+            # decoded images are cached as uint8 ("" in memory, otherwise in the given local file),
+            # so the shuffle buffer holds images instead of paths and should be bounded
+            dataset = dataset.map(
+                map_func=lambda example: resize(parse_example(example)),
+                num_parallel_calls=num_parallel_calls
+            )
+            dataset = dataset.cache(filename=cache)
+
+        if shuffle:
+            if cache is not None and shuffle_buffer_size is None:
+                # the buffer holds decoded images, a full shuffle of CelebA at 256x256 would take ~40GB
+                shuffle_buffer_size = CACHED_SHUFFLE_BUFFER_SIZE
+            dataset = dataset.shuffle(
+                buffer_size=shuffle_buffer_size or sum(map(count_records, filenames)),
+                reshuffle_each_iteration=True
+            )
+        dataset = dataset.repeat(count=num_epochs)
+        if cache is not None:
+            dataset = dataset.batch(batch_size=batch_size)
+        elif batch_then_decode:
+            dataset = dataset.batch(batch_size=batch_size)
+            dataset = dataset.map(
+                map_func=parse_examples,
+                num_parallel_calls=num_parallel_calls
+            )
+        else:
+            dataset = dataset.map(
+                map_func=parse_example,
+                num_parallel_calls=num_parallel_calls
+            )
+            dataset = dataset.batch(batch_size=batch_size)
     dataset = dataset.map(
         map_func=preprocess,
-        num_parallel_calls=os.cpu_count()
+        num_parallel_calls=num_parallel_calls
     )
-    dataset = dataset.prefetch(buffer_size=1)
+    dataset = dataset.prefetch(buffer_size=prefetch_buffer_size)
 
     iterator = dataset.make_one_shot_iterator()
+    if saveable:
+        add_saveable_iterator(iterator)
 
     return iterator.get_next()
+
+
+def autotune(input_fn):
+    ''' Lets the tf.data runtime pick parallelism and prefetch depth,
+        and for celeba reads record files interleaved and decodes whole batches at once.
+    '''
+    kwargs = dict(
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        prefetch_buffer_size=tf.data.experimental.AUTOTUNE
+    )
+    if getattr(input_fn, "func", input_fn) is celeba_input_fn:
+        kwargs.update(
+            num_parallel_reads=tf.data.experimental.AUTOTUNE,
+            batch_then_decode=True
+        )
+    return functools.partial(input_fn, **kwargs)
+
+
+def benchmark_input_fn(input_fn, num_steps, num_warmup_steps=10, config=None):
+    ''' Measures an input function in isolation of the model
+        (throughput in images/sec and per-batch latency).
+    '''
+    with tf.Graph().as_default():
+
+        inputs = input_fn()
+        images = inputs[0] if isinstance(inputs, tuple) else inputs
+        batch_size = tf.shape(images)[0]
+
+        with tf.Session(config=config) as session:
+
+            for _ in range(num_warmup_steps):
+                session.run(batch_size)
+
+            num_images = 0
+            latencies = []
+            for _ in range(num_steps):
+                begin = time.perf_counter()
+                try:
+                    num_images += session.run(batch_size)
+                except tf.errors.OutOfRangeError:
+                    break
+                latencies.append(time.perf_counter() - begin)
+
+    latencies = np.array(latencies)
+
+    return Struct(
+        images_per_sec=num_images / np.sum(latencies),
+        latency_mean=np.mean(latencies),
+        latency_stddev=np.std(latencies),
+        latency_p50=np.percentile(latencies, 50),
+        latency_p99=np.percentile(latencies, 99)
+    )
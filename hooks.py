@@ -0,0 +1,267 @@
+import tensorflow as tf
+import numpy as np
+import threading
+import queue
+import time
+import os
+
+
+class TimedSaver(tf.train.Saver):
+    ''' Saver which records how long its last restore took. '''
+
+    restore_time = 0.0
+
+    def restore(self, sess, save_path):
+        begin = time.perf_counter()
+        super().restore(sess, save_path)
+        self.restore_time = time.perf_counter() - begin
+
+
+class StartupProfilerHook(tf.train.SessionRunHook):
+    ''' Times the startup of a monitored session in separate phases:
+        graph construction (since graph_begin, a time.perf_counter() value),
+        variable restore (by saver, the TimedSaver of the scaffold),
+        the rest of session creation (initialization, other hooks' setup)
+        and the first step (runs_per_step session runs, input pipeline warm-up included).
+        The phases are logged and written as summaries to output_dir.
+    '''
+
+    def __init__(self, graph_begin=None, output_dir=None, saver=None, runs_per_step=1):
+        self.graph_begin = graph_begin
+        self.output_dir = output_dir
+        self.saver = saver
+        self.runs_per_step = runs_per_step
+
+    def begin(self):
+        self.times = {}
+        if self.graph_begin is not None:
+            self.times["startup/graph_build"] = time.perf_counter() - self.graph_begin
+        self.global_step = tf.train.get_global_step()
+        self.session_begin = time.perf_counter()
+        self.first_step_begin = None
+        self.num_runs = 0
+
+    def after_create_session(self, session, coord):
+        restore_time = self.saver.restore_time if self.saver else 0.0
+        if self.saver:
+            self.times["startup/variable_restore"] = restore_time
+        self.times["startup/session_creation"] = time.perf_counter() - self.session_begin - restore_time
+        self.first_step_global_step = session.run(self.global_step)
+        self.first_step_begin = time.perf_counter()
+        self.report()
+
+    def after_run(self, run_context, run_values):
+        if self.first_step_begin is not None:
+            self.num_runs += 1
+            if self.num_runs == self.runs_per_step:
+                self.times["startup/first_step"] = time.perf_counter() - self.first_step_begin
+                self.first_step_begin = None
+                self.report()
+
+    def report(self):
+        for name, value in self.times.items():
+            tf.logging.info("{}: {:.3f} sec".format(name, value))
+        if self.output_dir:
+            summary_writer = tf.summary.FileWriterCache.get(self.output_dir)
+            summary_writer.add_summary(tf.Summary(value=[
+                tf.Summary.Value(tag=name, simple_value=value)
+                for name, value in self.times.items()
+            ]), self.first_step_global_step)
+            summary_writer.flush()
+        self.times = {}
+
+
+class InputRestoreHook(tf.train.SessionRunHook):
+    ''' Restores input pipeline iterators (SAVEABLE_OBJECTS) from the latest checkpoint in checkpoint_dir.
+        Checkpoints without iterator states (e.g. written before the iterators were saveable)
+        are skipped, the input pipeline then starts afresh.
+    '''
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+
+    def begin(self):
+        saveables = tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS)
+        self.saver = tf.train.Saver(var_list=saveables) if saveables else None
+        self.keys = [spec.name for saveable in saveables for spec in saveable.specs]
+
+    def after_create_session(self, session, coord):
+        checkpoint = tf.train.latest_checkpoint(self.checkpoint_dir)
+        if not self.saver or not checkpoint:
+            return
+        names = {name for name, _ in tf.train.list_variables(checkpoint)}
+        if all(key in names for key in self.keys):
+            self.saver.restore(session, checkpoint)
+        else:
+            tf.logging.warning("{} holds no input pipeline state, the input starts afresh".format(checkpoint))
+
+
+class AsyncCheckpointSaverHook(tf.train.SessionRunHook):
+    ''' Checkpoints without stalling training.
+        Variables are snapshotted to host memory on the training thread and written by a background thread
+        through a shadow graph, so the checkpoints are restorable like the ones of CheckpointSaverHook.
+        Input pipeline iterators (SAVEABLE_OBJECTS) are saved synchronously next to the checkpoints
+        and restored for the restored global step.
+        Optionally exports the generator variables alone (e.g. as float16) at their own cadence.
+        A failed write is raised on the training thread at the next save (or at the end).
+    '''
+
+    def __init__(self, checkpoint_dir, save_steps, max_to_keep=10, keep_checkpoint_every_n_hours=12,
+                 export_steps=None, export_dtype=np.float32, export_scope="generator"):
+        self.checkpoint_dir = checkpoint_dir
+        self.max_to_keep = max_to_keep
+        self.keep_checkpoint_every_n_hours = keep_checkpoint_every_n_hours
+        self.export_dtype = export_dtype
+        self.export_scope = export_scope
+        self.save_timer = tf.train.SecondOrStepTimer(every_steps=save_steps)
+        self.export_timer = tf.train.SecondOrStepTimer(every_steps=export_steps) if export_steps else None
+
+    def begin(self):
+        self.global_step = tf.train.get_global_step()
+        self.variables = tf.global_variables()
+        # trainable variables only, optimizer slots live in the same scope
+        self.export_variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=self.export_scope)
+
+        # iterator states are variant tensors and can't be copied to host memory
+        saveables = tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS)
+        self.input_saver = tf.train.Saver(
+            var_list=saveables,
+            max_to_keep=self.max_to_keep,
+            keep_checkpoint_every_n_hours=self.keep_checkpoint_every_n_hours
+        ) if saveables else None
+
+        self.shadow_graph = tf.Graph()
+        with self.shadow_graph.as_default():
+            placeholders = [
+                tf.placeholder(variable.dtype.base_dtype, variable.shape)
+                for variable in self.variables
+            ]
+            shadow_variables = [
+                tf.Variable(tf.zeros(variable.shape, variable.dtype.base_dtype), trainable=False)
+                for variable in self.variables
+            ]
+            self.placeholders = placeholders
+            self.assign_op = tf.group(*[
+                shadow_variable.assign(placeholder)
+                for shadow_variable, placeholder in zip(shadow_variables, placeholders)
+            ])
+            # checkpoint keys are the names of the training variables
+            self.saver = tf.train.Saver(
+                var_list={variable.op.name: shadow_variable for variable, shadow_variable in zip(self.variables, shadow_variables)},
+                max_to_keep=self.max_to_keep,
+                keep_checkpoint_every_n_hours=self.keep_checkpoint_every_n_hours
+            )
+            initializer = tf.variables_initializer(shadow_variables)
+        self.shadow_graph.finalize()
+
+        self.shadow_session = tf.Session(graph=self.shadow_graph, config=tf.ConfigProto(device_count=dict(GPU=0)))
+        self.shadow_session.run(initializer)
+
+        # at most one pending snapshot, so host memory stays bounded when writes are slower than snapshots
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # the thread keeps draining the queue after a failure, so the training thread never blocks on it
+            try:
+                self.write_item(*item)
+            except Exception as error:
+                tf.logging.error("asynchronous write failed: {}".format(error))
+                self.error = error
+
+    def write_item(self, kind, global_step, values):
+        if kind == "checkpoint":
+            self.shadow_session.run(self.assign_op, feed_dict=dict(zip(self.placeholders, values)))
+            self.saver.save(
+                sess=self.shadow_session,
+                save_path=os.path.join(self.checkpoint_dir, "model.ckpt"),
+                global_step=global_step,
+                write_meta_graph=False
+            )
+            tf.logging.info("saved checkpoint for step {}".format(global_step))
+        else:
+            export_dir = os.path.join(self.checkpoint_dir, "exports")
+            os.makedirs(export_dir, exist_ok=True)
+            filename = os.path.join(export_dir, "{}-{}.npz".format(self.export_scope, global_step))
+            with open("{}.tmp".format(filename), "wb") as file:
+                np.savez(file, global_step=global_step, **{
+                    variable.op.name: value.astype(self.export_dtype)
+                    if np.issubdtype(value.dtype, np.floating) else value
+                    for variable, value in zip(self.export_variables, values)
+                })
+            os.replace(file.name, filename)
+            tf.logging.info("exported {} for step {}".format(self.export_scope, global_step))
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("asynchronous checkpoint write failed") from self.error
+
+    def input_checkpoint(self, global_step):
+        return os.path.join(self.checkpoint_dir, "input.ckpt-{}".format(global_step))
+
+    def save(self, session, global_step):
+        self.check()
+        self.save_timer.update_last_triggered_step(global_step)
+        if self.input_saver:
+            self.input_saver.save(
+                sess=session,
+                save_path=os.path.join(self.checkpoint_dir, "input.ckpt"),
+                global_step=global_step,
+                latest_filename="input_checkpoint",
+                write_meta_graph=False
+            )
+        self.queue.put(("checkpoint", global_step, session.run(self.variables)))
+
+    def snapshot(self, session, global_step):
+        if self.save_timer.should_trigger_for_step(global_step):
+            self.save(session, global_step)
+        if self.export_timer and self.export_timer.should_trigger_for_step(global_step):
+            self.export_timer.update_last_triggered_step(global_step)
+            self.check()
+            self.queue.put(("export", global_step, session.run(self.export_variables)))
+
+    def after_create_session(self, session, coord):
+        global_step = session.run(self.global_step)
+        if self.input_saver and tf.train.checkpoint_exists(self.input_checkpoint(global_step)):
+            self.input_saver.restore(session, self.input_checkpoint(global_step))
+        self.save_timer.update_last_triggered_step(global_step)
+        if self.export_timer:
+            self.export_timer.update_last_triggered_step(global_step)
+
+    def before_run(self, run_context):
+        return tf.train.SessionRunArgs(self.global_step)
+
+    def after_run(self, run_context, run_values):
+        stale_global_step = run_values.results
+        if self.save_timer.should_trigger_for_step(stale_global_step + 1) or (
+            self.export_timer and self.export_timer.should_trigger_for_step(stale_global_step + 1)
+        ):
+            self.snapshot(run_context.session, run_context.session.run(self.global_step))
+
+    def end(self, session):
+        try:
+            global_step = session.run(self.global_step)
+            if global_step != self.save_timer.last_triggered_step():
+                self.save(session, global_step)
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.shadow_session.close()
+        self.check()
+
+
+def load_generator_export(session, filename, scope="generator"):
+    ''' Loads an export of AsyncCheckpointSaverHook into the variables of the current graph
+        (and its global step, which drives the growing level).
+    '''
+    values = np.load(filename)
+    for variable in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=scope):
+        variable.load(values[variable.op.name].astype(variable.dtype.as_numpy_dtype), session)
+    if tf.train.get_global_step() is not None and "global_step" in values:
+        tf.train.get_global_step().load(values["global_step"], session)
@@ -7,9 +7,22 @@
 import tensorflow as tf
 import argparse
 import functools
-from dataset import celeba_input_fn
+import hashlib
+import json
+import time
+import os
+from dataset import celeba_input_fn, autotune, benchmark_input_fn, reattach_saveable_iterators
 from model import GAN
 from network import StyleGAN
+from ops import apply_noise
+from hooks import load_generator_export
+from projection import Projector
+from truncation import load_average_latents
+from scorer import Scorer
+import quantization
+from renderer import Renderer, FrameWriter, VideoWriter
+from cache import GenerationCache, renderer_fn, checkpoint_id
+import numpy as np
 from utils import Struct
 
 parser = argparse.ArgumentParser()
@@ -19,77 +32,420 @@ parser.add_argument('--filenames', type=str, nargs="+", default=["celeba_train.t
 parser.add_argument("--batch_size", type=int, default=16)
 parser.add_argument("--num_epochs", type=int, default=None)
 parser.add_argument("--total_steps", type=int, default=1000000)
+parser.add_argument("--train_steps", type=int, default=None)
+parser.add_argument("--resolution", type=int, default=256)
+parser.add_argument("--min_channels", type=int, default=16)
+parser.add_argument("--max_channels", type=int, default=512)
+parser.add_argument("--mapping_layers", type=int, default=8)
+parser.add_argument("--generator_learning_rate", type=float, default=2e-3)
+parser.add_argument("--generator_beta1", type=float, default=0.0)
+parser.add_argument("--generator_beta2", type=float, default=0.99)
+parser.add_argument("--discriminator_learning_rate", type=float, default=2e-3)
+parser.add_argument("--discriminator_beta1", type=float, default=0.0)
+parser.add_argument("--discriminator_beta2", type=float, default=0.99)
+parser.add_argument("--real_gradient_penalty_weight", type=float, default=5.0)
+parser.add_argument("--fake_gradient_penalty_weight", type=float, default=0.0)
+parser.add_argument("--save_checkpoint_steps", type=int, default=10000)
 parser.add_argument('--train', action="store_true")
 parser.add_argument('--evaluate', action="store_true")
+parser.add_argument('--evaluate_continuously', action="store_true")
+parser.add_argument("--num_eval_workers", type=int, default=4)
+parser.add_argument("--eval_timeout", type=int, default=None)
+parser.add_argument("--eval_steps", type=int, default=None)
 parser.add_argument('--generate', action="store_true")
+parser.add_argument("--num_samples", type=int, default=64)
+parser.add_argument("--truncation_psi", type=float, default=0.7)
+parser.add_argument("--truncation_cutoff", type=int, default=4)
+parser.add_argument("--noise_mode", type=str, choices=["random", "static", "seeded", "zero"], default="random")
+parser.add_argument('--project', action="store_true")
+parser.add_argument("--project_dir", type=str, default="celeba_style_gan_projections")
+parser.add_argument('--project_filenames', type=str, nargs="+", default=[])
+parser.add_argument("--project_batch_size", type=int, default=256)
+parser.add_argument("--project_steps", type=int, default=1000)
+parser.add_argument("--project_patience", type=int, default=50)
+parser.add_argument("--project_loss", type=str, default="perceptual")
+parser.add_argument('--score', action="store_true")
+parser.add_argument('--score_filenames', type=str, nargs="+", default=[])
+parser.add_argument("--score_output", type=str, default="scores.tsv")
+parser.add_argument("--score_batch_size", type=int, default=256)
+parser.add_argument("--serve", type=str, choices=["stdio", "http"], default=None)
+parser.add_argument("--host", type=str, default="localhost")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument('--quantize', action="store_true")
+parser.add_argument("--quantized_model", type=str, default="celeba_style_gan_int8.npz")
+parser.add_argument('--render_grid', action="store_true")
+parser.add_argument("--grid_rows", type=int, default=4)
+parser.add_argument("--grid_columns", type=int, default=6)
+parser.add_argument("--crossover_depths", type=int, nargs="+", default=[2])
+parser.add_argument('--render_video', action="store_true")
+parser.add_argument("--num_keyframes", type=int, default=8)
+parser.add_argument("--frames_per_keyframe", type=int, default=60)
+parser.add_argument("--interpolation_space", type=str, choices=["z", "w"], default="w")
+parser.add_argument("--video_filename", type=str, default=None)
+parser.add_argument('--seeds', type=int, nargs="+", default=[])
+parser.add_argument('--mixing_seeds', type=int, nargs="+", default=[])
+parser.add_argument("--cache_dir", type=str, default=None)
+parser.add_argument("--cache_capacity", type=int, default=1024)
+parser.add_argument("--cache_max_bytes", type=int, default=1 << 30)
+parser.add_argument('--benchmark_input', action="store_true")
+parser.add_argument("--benchmark_steps", type=int, default=1000)
+parser.add_argument('--autotune_input', action="store_true")
+parser.add_argument("--input_cache", type=str, nargs="?", const="", default=None)
+parser.add_argument("--input_memmap", type=str, default=None)
+parser.add_argument("--shuffle_buffer_size", type=int, default=None)
+parser.add_argument('--async_checkpoint', action="store_true")
+parser.add_argument("--export_generator_steps", type=int, default=None)
+parser.add_argument("--export_dtype", type=str, default="float32")
+parser.add_argument("--generator_export", type=str, default=None)
 parser.add_argument("--gpu", type=str, default="0")
+parser.add_argument("--data_format", type=str, choices=["NCHW", "NHWC"], default="NCHW")
+parser.add_argument("--intra_op_threads", type=int, default=0)
+parser.add_argument("--inter_op_threads", type=int, default=0)
+parser.add_argument("--graph_cache_dir", type=str, default=None)
 args = parser.parse_args()
 
+if args.graph_cache_dir:
+    if args.input_memmap:
+        parser.error("--input_memmap pipelines (py_func) can't be serialized to a MetaGraph")
+    if any([args.project, args.generate, args.score, args.quantize, args.render_grid, args.render_video, args.seeds]):
+        parser.error("--graph_cache_dir only applies to --train, --evaluate and --evaluate_continuously")
+
 tf.logging.set_verbosity(tf.logging.INFO)
 
+# py_func (memmap) pipelines can't be checkpointed, cached ones would checkpoint decoded images
+unsaveable_arguments = [name for name in ["input_memmap", "input_cache"] if getattr(args, name) is not None]
+if args.train and unsaveable_arguments:
+    tf.logging.warning("{}: input iterators are not checkpointed, a resumed run restarts its pass over the data".format(
+        ", ".join("--{}".format(name) for name in unsaveable_arguments)
+    ))
+
+real_input_fn = functools.partial(
+    celeba_input_fn,
+    filenames=args.filenames,
+    batch_size=args.batch_size,
+    num_epochs=args.num_epochs if args.train else 1,
+    shuffle=True if args.train else False,
+    image_size=[args.resolution, args.resolution],
+    num_parallel_calls=args.intra_op_threads or None,
+    cache=args.input_cache,
+    shuffle_buffer_size=args.shuffle_buffer_size,
+    memmap_filename=args.input_memmap,
+    saveable=args.train and not unsaveable_arguments
+)
+if args.autotune_input:
+    real_input_fn = autotune(real_input_fn)
+
+# 0 lets TensorFlow use every core, concurrent processes should split the cores between them
+config = tf.ConfigProto(
+    intra_op_parallelism_threads=args.intra_op_threads,
+    inter_op_parallelism_threads=args.inter_op_threads,
+    gpu_options=tf.GPUOptions(
+        visible_device_list=args.gpu,
+        allow_growth=True
+    )
+)
+
+if args.benchmark_input:
+    benchmark = benchmark_input_fn(
+        input_fn=real_input_fn,
+        num_steps=args.benchmark_steps,
+        config=config
+    )
+    tf.logging.info("input pipeline benchmark: {}".format(benchmark))
+
+def graph_cache_filename(args):
+    # only the arguments which shape the train / evaluate graph make up the key,
+    # evaluate and evaluate_continuously build the same graph (training=False)
+    graph_arguments = [
+        # architecture
+        "resolution", "min_channels", "max_channels", "mapping_layers", "data_format", "total_steps",
+        # hyper-parameters
+        "generator_learning_rate", "generator_beta1", "generator_beta2",
+        "discriminator_learning_rate", "discriminator_beta1", "discriminator_beta2",
+        "real_gradient_penalty_weight", "fake_gradient_penalty_weight",
+        # input pipeline (intra_op_threads sets its parallelism)
+        "filenames", "batch_size", "num_epochs", "autotune_input", "input_cache", "input_memmap",
+        "shuffle_buffer_size", "intra_op_threads",
+        # mode
+        "train"
+    ]
+    key = json.dumps({name: getattr(args, name) for name in graph_arguments}, sort_keys=True)
+    return os.path.join(args.graph_cache_dir, "{}.meta".format(hashlib.sha256(key.encode()).hexdigest()[:16]))
+
+
+graph_begin = time.perf_counter()
+
 with tf.Graph().as_default():
 
     tf.set_random_seed(0)
 
-    style_gan = StyleGAN(
-        min_resolution=[4, 4],
-        max_resolution=[256, 256],
-        min_channels=16,
-        max_channels=512,
-        mapping_layers=8,
-        growing_level=tf.cast(tf.divide(
-            x=tf.train.create_global_step(),
-            y=args.total_steps
-        ), tf.float32),
-        switching_level=tf.random_uniform([])
-    )
+    graph_filename = graph_cache_filename(args) if args.graph_cache_dir else None
+    if graph_filename:
+        os.makedirs(args.graph_cache_dir, exist_ok=True)
 
-    gan = GAN(
-        generator=style_gan.generator,
-        discriminator=style_gan.discriminator,
-        real_input_fn=functools.partial(
-            celeba_input_fn,
-            filenames=args.filenames,
-            batch_size=args.batch_size,
-            num_epochs=args.num_epochs if args.train else 1,
-            shuffle=True if args.train else False,
-            image_size=[256, 256]
-        ),
-        fake_input_fn=lambda: (
-            tf.random_normal([args.batch_size, 512]),
-            tf.random_normal([args.batch_size, 512])
-        ),
-        hyper_params=Struct(
-            generator_learning_rate=2e-3,
-            generator_beta1=0.0,
-            generator_beta2=0.99,
-            discriminator_learning_rate=2e-3,
-            discriminator_beta1=0.0,
-            discriminator_beta2=0.99,
-            real_gradient_penalty_weight=5.0,
-            fake_gradient_penalty_weight=0.0,
+    if graph_filename and os.path.exists(graph_filename):
+        # the whole graph (global step included) comes from the MetaGraph
+        tf.logging.info("importing cached graph: {}".format(graph_filename))
+        gan = GAN.from_meta_graph(graph_filename)
+        reattach_saveable_iterators()
+
+    else:
+        architecture = Struct(
+            min_resolution=[4, 4],
+            max_resolution=[args.resolution, args.resolution],
+            min_channels=args.min_channels,
+            max_channels=args.max_channels,
+            mapping_layers=args.mapping_layers
         )
-    )
 
-    config = tf.ConfigProto(
-        gpu_options=tf.GPUOptions(
-            visible_device_list=args.gpu,
-            allow_growth=True
+        style_gan = StyleGAN(
+            **architecture,
+            growing_level=tf.cast(tf.divide(
+                x=tf.train.create_global_step(),
+                y=args.total_steps
+            ), tf.float32),
+            switching_level=tf.random_uniform([]),
+            data_format=args.data_format
         )
-    )
+
+        if args.train or args.evaluate or args.evaluate_continuously:
+
+            gan = GAN(
+                generator=style_gan.generator,
+                discriminator=style_gan.discriminator,
+                real_input_fn=real_input_fn,
+                fake_input_fn=lambda: (
+                    tf.random_normal([args.batch_size, 512]),
+                    tf.random_normal([args.batch_size, 512])
+                ),
+                hyper_params=Struct(
+                    generator_learning_rate=args.generator_learning_rate,
+                    generator_beta1=args.generator_beta1,
+                    generator_beta2=args.generator_beta2,
+                    discriminator_learning_rate=args.discriminator_learning_rate,
+                    discriminator_beta1=args.discriminator_beta1,
+                    discriminator_beta2=args.discriminator_beta2,
+                    real_gradient_penalty_weight=args.real_gradient_penalty_weight,
+                    fake_gradient_penalty_weight=args.fake_gradient_penalty_weight,
+                ),
+                training=args.train
+            )
+
+            if graph_filename:
+                # exported before training / evaluation add their own ops,
+                # saveable iterators can't be serialized and are reattached on import
+                tf.train.export_meta_graph(
+                    filename="{}.{}.tmp".format(graph_filename, os.getpid()),
+                    clear_devices=True,
+                    collection_list=[
+                        key for key in tf.get_default_graph().get_all_collection_keys()
+                        if key != tf.GraphKeys.SAVEABLE_OBJECTS
+                    ]
+                )
+                os.replace("{}.{}.tmp".format(graph_filename, os.getpid()), graph_filename)
 
     if args.train:
         gan.train(
             model_dir=args.model_dir,
-            total_steps=args.total_steps,
-            save_checkpoint_steps=10000,
+            # total_steps sets the growing schedule, train_steps can stop earlier (and resume later)
+            total_steps=args.train_steps or args.total_steps,
+            save_checkpoint_steps=args.save_checkpoint_steps,
             save_summary_steps=1000,
             log_tensor_steps=1000,
-            config=config
+            config=config,
+            async_checkpoint=args.async_checkpoint,
+            export_generator_steps=args.export_generator_steps,
+            export_dtype=args.export_dtype,
+            graph_begin=graph_begin
         )
 
     if args.evaluate:
         gan.evaluate(
             model_dir=args.model_dir,
+            config=config,
+            num_workers=args.num_eval_workers,
+            num_steps=args.eval_steps,
+            graph_begin=graph_begin
+        )
+
+    if args.evaluate_continuously:
+        gan.evaluate_continuously(
+            model_dir=args.model_dir,
+            config=config,
+            num_workers=args.num_eval_workers,
+            timeout=args.eval_timeout
+        )
+
+    if args.project:
+        projector = Projector(
+            style_gan=style_gan,
+            num_images=args.project_batch_size,
+            image_size=[args.resolution, args.resolution],
+            loss=args.project_loss,
+            average_latents=load_average_latents(style_gan, args.model_dir, config=config)
+        )
+        projector.project(
+            filenames=args.project_filenames,
+            output_dir=args.project_dir,
+            model_dir=args.model_dir,
+            num_steps=args.project_steps,
+            patience=args.project_patience,
             config=config
         )
+
+    if args.generate:
+
+        # psi = 1 disables the truncation trick
+        truncation = Struct(
+            average_latents=load_average_latents(
+                style_gan, args.model_dir, config=config, generator_export=args.generator_export
+            ),
+            psi=args.truncation_psi,
+            cutoff_depth=args.truncation_cutoff
+        ) if args.truncation_psi < 1 else None
+
+        sample_ids = tf.placeholder(tf.int64, [args.batch_size])
+
+        with tf.variable_scope("generator"):
+            latents = style_gan.mapping_network(tf.random_normal([args.batch_size, 512]))
+            with tf.contrib.framework.arg_scope([apply_noise], noise_mode=args.noise_mode, sample_ids=sample_ids):
+                fake_images = style_gan.systhesis_network(latents, latents, truncation)
+
+        fake_images = tf.transpose(fake_images, [0, 2, 3, 1])
+        fake_images = tf.image.convert_image_dtype(fake_images * 0.5 + 0.5, tf.uint8, saturate=True)
+        fake_images = tf.map_fn(tf.image.encode_png, fake_images, dtype=tf.string)
+
+        restored_variables = [
+            *tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="generator"),
+            tf.train.get_global_step()
+        ]
+        saver = tf.train.Saver(restored_variables)
+
+        os.makedirs(args.sample_dir, exist_ok=True)
+
+        with tf.Session(config=config) as session:
+            session.run(tf.local_variables_initializer())
+            # a generator export is a fraction of a full checkpoint (no discriminator, no optimizer slots)
+            if args.generator_export:
+                session.run(tf.variables_initializer(restored_variables))
+                load_generator_export(session, args.generator_export)
+            else:
+                saver.restore(session, tf.train.latest_checkpoint(args.model_dir))
+            for begin in range(0, args.num_samples, args.batch_size):
+                feed_dict = {sample_ids: np.arange(begin, begin + args.batch_size)}
+                for i, image in enumerate(session.run(fake_images, feed_dict=feed_dict)[:args.num_samples - begin]):
+                    with open(os.path.join(args.sample_dir, "{}.png".format(begin + i)), "wb") as file:
+                        file.write(image)
+
+    if args.score:
+
+        scorer = Scorer(
+            style_gan=style_gan,
+            image_size=[args.resolution, args.resolution],
+            batch_size=args.score_batch_size
+        )
+
+        with scorer.session(args.model_dir, config) as session:
+            if args.serve == "stdio":
+                scorer.serve_stdio(session)
+            elif args.serve == "http":
+                scorer.serve_http(session, args.host, args.port)
+            else:
+                scorer.score_files(session, args.score_filenames, args.score_output)
+
+    if args.quantize:
+
+        # fully grown generator without style mixing, NHWC for CPU serving
+        static_style_gan = StyleGAN(
+            **architecture,
+            growing_level=1.0,
+            switching_level=1.0,
+            data_format="NHWC"
+        )
+
+        checkpoint = tf.train.latest_checkpoint(args.model_dir)
+        artifact = quantization.quantize(
+            style_gan=static_style_gan,
+            checkpoint=checkpoint,
+            filename=args.quantized_model,
+            config=config
+        )
+        report = quantization.report(
+            style_gan=static_style_gan,
+            checkpoint=checkpoint,
+            artifact=artifact,
+            real_input_fn=real_input_fn,
+            config=config
+        )
+        for name, value in report.items():
+            tf.logging.info("{}: {}".format(name, value))
+
+    if args.render_grid or args.render_video or args.seeds:
+
+        renderer = Renderer(
+            style_gan=style_gan,
+            noise_mode=args.noise_mode,
+            truncation=Struct(
+                average_latents=load_average_latents(
+                    style_gan, args.model_dir, config=config, generator_export=args.generator_export
+                ),
+                psi=args.truncation_psi,
+                cutoff_depth=args.truncation_cutoff
+            ) if args.truncation_psi < 1 else None
+        )
+
+        random = np.random.RandomState(0)
+        os.makedirs(args.sample_dir, exist_ok=True)
+
+        with renderer.session(args.model_dir, config, args.generator_export) as session:
+
+            if args.render_grid:
+                grid = renderer.style_mixing_grid(
+                    session=session,
+                    row_latents=random.normal(size=[args.grid_rows, 512]),
+                    column_latents=random.normal(size=[args.grid_columns, 512]),
+                    crossover_depths=args.crossover_depths if len(args.crossover_depths) > 1 else args.crossover_depths[0],
+                    batch_size=args.batch_size
+                )
+                with open(os.path.join(args.sample_dir, "style_mixing_grid.png"), "wb") as file:
+                    file.write(renderer.encode_png(session, grid))
+
+            if args.seeds:
+                # images for seeds (optionally style-mixed with mixing seeds) through the generation cache
+                settings = dict(
+                    truncation_psi=args.truncation_psi,
+                    truncation_cutoff=args.truncation_cutoff,
+                    noise_mode=args.noise_mode,
+                    # seeded noise banks are laid out per data format
+                    data_format=args.data_format,
+                    resolution=args.resolution
+                )
+                cache = GenerationCache(
+                    render_fn=renderer_fn(renderer, session, args.batch_size),
+                    checkpoint_id=checkpoint_id(args.generator_export or tf.train.latest_checkpoint(args.model_dir)),
+                    settings=settings,
+                    capacity=args.cache_capacity,
+                    cache_dir=args.cache_dir,
+                    max_bytes=args.cache_max_bytes
+                )
+                requests = [
+                    dict(seed=seed, mixing_seed=mixing_seed, crossover_depth=args.crossover_depths[0])
+                    for seed, mixing_seed in zip(args.seeds, args.mixing_seeds or [None] * len(args.seeds))
+                ]
+                for request, image in zip(requests, cache.get(requests)):
+                    with open(os.path.join(args.sample_dir, "seed_{seed}_{mixing_seed}.png".format(**request)), "wb") as file:
+                        file.write(image)
+                tf.logging.info("generation cache: {}".format(cache.metrics()))
+
+            if args.render_video:
+                renderer.interpolate(
+                    session=session,
+                    keyframe_latents=random.normal(size=[args.num_keyframes, 512]),
+                    num_frames=args.frames_per_keyframe,
+                    space=args.interpolation_space,
+                    batch_size=args.batch_size,
+                    writer=VideoWriter(args.video_filename) if args.video_filename else FrameWriter(
+                        directory=os.path.join(args.sample_dir, "interpolation"),
+                        encode_fn=functools.partial(renderer.encode_png, session)
+                    )
+                )
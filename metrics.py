@@ -18,14 +18,79 @@ def inception_score(logits):
     return np.exp(np.mean(kl_divergence(p, q)))
 
 
+class StreamingInceptionScore(object):
+    ''' Inception score over splits accumulated batch by batch,
+        samples are assigned to splits round-robin.
+    '''
+
+    def __init__(self, num_splits=10):
+        self.num_splits = num_splits
+        self.num_samples = 0
+        self.counts = np.zeros(num_splits)
+        self.probabilities = 0
+        self.entropies = np.zeros(num_splits)
+
+    def update(self, logits):
+        p = softmax(np.asarray(logits, dtype=np.float64))
+        splits = (self.num_samples + np.arange(len(p))) % self.num_splits
+        probabilities = np.zeros([self.num_splits, p.shape[1]])
+        np.add.at(probabilities, splits, p)
+        np.add.at(self.entropies, splits, np.sum(p * np.log(np.maximum(p, 1e-30)), axis=1))
+        np.add.at(self.counts, splits, 1)
+        self.probabilities = self.probabilities + probabilities
+        self.num_samples += len(p)
+
+    def result(self):
+        # E[KL(p(y|x) || p(y))] = E[sum p(y|x) log p(y|x)] - sum p(y) log p(y)
+        q = self.probabilities / self.counts[:, np.newaxis]
+        scores = np.exp(self.entropies / self.counts - np.sum(q * np.log(np.maximum(q, 1e-30)), axis=1))
+        return np.mean(scores), np.std(scores)
+
+
+class StreamingMoments(object):
+    ''' Mean and covariance of features accumulated batch by batch. '''
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.outer_sum = 0
+
+    def update(self, features):
+        features = np.asarray(features, dtype=np.float64)
+        self.count += len(features)
+        self.sum = self.sum + np.sum(features, axis=0)
+        self.outer_sum = self.outer_sum + np.dot(features.T, features)
+
+    def mean(self):
+        return self.sum / self.count
+
+    def covariance(self):
+        mean = self.mean()
+        return (self.outer_sum - self.count * np.outer(mean, mean)) / (self.count - 1)
+
+
 def frechet_inception_distance(real_features, fake_features):
     real_mean = np.mean(real_features, axis=0)
     fake_mean = np.mean(fake_features, axis=0)
     real_cov = np.cov(real_features, rowvar=False)
     fake_cov = np.cov(fake_features, rowvar=False)
+    return frechet_distance(real_mean, real_cov, fake_mean, fake_cov)
+
+
+def frechet_distance(real_mean, real_cov, fake_mean, fake_cov, epsilon=1e-6):
+
+    def is_valid(mean_cov):
+        return np.isfinite(mean_cov).all() and (
+            not np.iscomplexobj(mean_cov) or np.allclose(np.diagonal(mean_cov).imag, 0, atol=1e-3)
+        )
+
     mean_cov = sp.linalg.sqrtm(np.dot(real_cov, fake_cov))
+    if not is_valid(mean_cov):
+        # covariances are singular with fewer samples than feature dimensions, epsilon * I regularizes them
+        offset = np.eye(len(real_cov)) * epsilon
+        mean_cov = sp.linalg.sqrtm(np.dot(real_cov + offset, fake_cov + offset))
     if np.iscomplexobj(mean_cov):
-        if not np.allclose(np.diagonal(mean_cov).imag, 0, atol=1e-3):
+        if not is_valid(mean_cov):
             raise ValueError("Imaginary component {}".format(np.max(np.abs(mean_cov.imag))))
         mean_cov = mean_cov.real
     return np.sum((real_mean - fake_mean) ** 2) + np.trace(real_cov + fake_cov - 2 * mean_cov)
@@ -1,14 +1,36 @@
 import tensorflow as tf
 import numpy as np
+import concurrent.futures
+import threading
+import itertools
 import metrics
+import hooks
+import csv
+import os
 
 
 class GAN(object):
 
-    def __init__(self, generator, discriminator, real_input_fn, fake_input_fn, hyper_params):
+    # tensors and ops of a GAN are kept in these collections, so that it can be restored from a MetaGraph
+    COLLECTIONS = [
+        "real_images",
+        "fake_images",
+        "generator_loss",
+        "discriminator_loss",
+        "generator_train_op",
+        "discriminator_train_op"
+    ]
+
+    def __init__(self, generator, discriminator, real_input_fn, fake_input_fn, hyper_params, training=True):
         # =========================================================================================
         real_images = real_input_fn()
         fake_images = generator(*fake_input_fn())
+        self.real_images = tf.transpose(real_images, [0, 2, 3, 1])
+        self.fake_images = tf.transpose(fake_images, [0, 2, 3, 1])
+        # evaluation only needs the images, no discriminator, losses or optimizers
+        if not training:
+            self.add_to_collections()
+            return
         # =========================================================================================
         real_logits = discriminator(real_images)
         fake_logits = discriminator(fake_images)
@@ -66,14 +88,41 @@ class GAN(object):
             var_list=discriminator_variables
         )
         # =========================================================================================
-        self.real_images = tf.transpose(real_images, [0, 2, 3, 1])
-        self.fake_images = tf.transpose(fake_images, [0, 2, 3, 1])
         self.generator_loss = generator_loss
         self.discriminator_loss = discriminator_loss
         self.generator_train_op = generator_train_op
         self.discriminator_train_op = discriminator_train_op
+        self.add_to_collections()
+
+    def add_to_collections(self):
+        for name in self.COLLECTIONS:
+            if hasattr(self, name):
+                tf.add_to_collection("gan/{}".format(name), getattr(self, name))
 
-    def train(self, model_dir, total_steps, save_checkpoint_steps, save_summary_steps, log_tensor_steps, config):
+    @classmethod
+    def from_meta_graph(cls, filename):
+        ''' Imports a MetaGraph exported right after constructing a GAN into the default graph
+            instead of building it again.
+        '''
+        tf.train.import_meta_graph(filename)
+        gan = cls.__new__(cls)
+        for name in cls.COLLECTIONS:
+            values = tf.get_collection("gan/{}".format(name))
+            if values:
+                setattr(gan, name, values[0])
+        return gan
+
+    def train(self, model_dir, total_steps, save_checkpoint_steps, save_summary_steps, log_tensor_steps, config,
+              async_checkpoint=False, export_generator_steps=None, export_dtype=np.float32, graph_begin=None):
+
+        # variables only, timed for the startup profile;
+        # input pipeline iterators are restored by InputRestoreHook or AsyncCheckpointSaverHook,
+        # so that checkpoints without them can still be resumed
+        saver = hooks.TimedSaver(
+            var_list=tf.global_variables(),
+            sharded=True,
+            allow_empty=True
+        )
 
         with tf.train.SingularMonitoredSession(
             scaffold=tf.train.Scaffold(
@@ -81,19 +130,37 @@ class GAN(object):
                 local_init_op=tf.group(
                     tf.local_variables_initializer(),
                     tf.tables_initializer()
-                )
+                ),
+                saver=saver
             ),
             checkpoint_dir=model_dir,
             config=config,
             hooks=[
-                tf.train.CheckpointSaverHook(
+                # first, so that the other hooks' setup counts as session creation
+                hooks.StartupProfilerHook(
+                    graph_begin=graph_begin,
+                    output_dir=model_dir,
+                    saver=saver,
+                    # a training step runs the discriminator and then the generator
+                    runs_per_step=2
+                ),
+                hooks.AsyncCheckpointSaverHook(
+                    checkpoint_dir=model_dir,
+                    save_steps=save_checkpoint_steps,
+                    max_to_keep=10,
+                    keep_checkpoint_every_n_hours=12,
+                    export_steps=export_generator_steps,
+                    export_dtype=export_dtype
+                ) if async_checkpoint else tf.train.CheckpointSaverHook(
                     checkpoint_dir=model_dir,
                     save_steps=save_checkpoint_steps,
+                    # variables and input pipeline iterators
                     saver=tf.train.Saver(
                         max_to_keep=10,
                         keep_checkpoint_every_n_hours=12,
                     )
                 ),
+                *([] if async_checkpoint else [hooks.InputRestoreHook(model_dir)]),
                 tf.train.SummarySaverHook(
                     output_dir=model_dir,
                     save_steps=save_summary_steps,
@@ -132,35 +199,165 @@ class GAN(object):
                 session.run(self.discriminator_train_op)
                 session.run(self.generator_train_op)
 
-    def evaluate(self, model_dir, config):
-
+    def inception_outputs(self):
+        # pool_3 features and logits of the generated images come from one Inception pass
         real_features = tf.contrib.gan.eval.run_inception(
             images=tf.contrib.gan.eval.preprocess_image(self.real_images),
             output_tensor="pool_3:0"
         )
-        fake_features = tf.contrib.gan.eval.run_inception(
+        fake_features, fake_logits = tf.contrib.gan.eval.run_inception(
             images=tf.contrib.gan.eval.preprocess_image(self.fake_images),
-            output_tensor="pool_3:0"
+            output_tensor=["pool_3:0", "logits:0"]
+        )
+
+        return real_features, fake_features, fake_logits
+
+    def score(self, session, inception_outputs, num_workers=1, num_steps=None):
+        ''' Computes FID, IS and the number of different bins from one pass over the data
+            (or its first num_steps batches). FID and IS are accumulated from streamed statistics.
+        '''
+        real_moments = metrics.StreamingMoments()
+        fake_moments = metrics.StreamingMoments()
+        inception_score = metrics.StreamingInceptionScore()
+        real_features = []
+        fake_features = []
+        lock = threading.Lock()
+        steps = itertools.count()
+
+        # session.run is thread-safe and releases the GIL,
+        # so workers share the input pipeline and run batches concurrently
+        def worker():
+            while num_steps is None or next(steps) < num_steps:
+                try:
+                    real, fake, logits = session.run(inception_outputs)
+                except tf.errors.OutOfRangeError:
+                    break
+                with lock:
+                    real_moments.update(real)
+                    fake_moments.update(fake)
+                    inception_score.update(logits)
+                    real_features.append(real)
+                    fake_features.append(fake)
+
+        with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+            for future in [executor.submit(worker) for _ in range(num_workers)]:
+                future.result()
+
+        return dict(
+            frechet_inception_distance=metrics.frechet_distance(
+                real_mean=real_moments.mean(),
+                real_cov=real_moments.covariance(),
+                fake_mean=fake_moments.mean(),
+                fake_cov=fake_moments.covariance()
+            ),
+            inception_score=inception_score.result()[0],
+            num_different_bins=metrics.num_different_bins(
+                real_features=np.concatenate(real_features),
+                fake_features=np.concatenate(fake_features)
+            )
         )
 
+    def evaluate(self, model_dir, config, num_workers=1, num_steps=None, graph_begin=None):
+        ''' Scores the latest checkpoint once, results are appended to eval/results.csv. '''
+        inception_outputs = self.inception_outputs()
+        saver = hooks.TimedSaver(sharded=True, allow_empty=True)
+
         with tf.train.SingularMonitoredSession(
             scaffold=tf.train.Scaffold(
                 init_op=tf.global_variables_initializer(),
                 local_init_op=tf.group(
                     tf.local_variables_initializer(),
                     tf.tables_initializer()
-                )
+                ),
+                saver=saver
             ),
             checkpoint_dir=model_dir,
-            config=config
+            config=config,
+            hooks=[
+                hooks.StartupProfilerHook(
+                    graph_begin=graph_begin,
+                    output_dir=os.path.join(model_dir, "eval"),
+                    saver=saver
+                )
+            ]
         ) as session:
 
-            def generator():
-                while True:
-                    try:
-                        yield session.run([real_features, fake_features])
-                    except tf.errors.OutOfRangeError:
-                        break
+            scores = self.score(session.raw_session(), inception_outputs, num_workers, num_steps)
+            global_step = session.raw_session().run(tf.train.get_global_step())
+            for name, value in scores.items():
+                tf.logging.info("{}: {}".format(name, value))
+
+        ResultsTable(os.path.join(model_dir, "eval", "results.csv")).append(
+            checkpoint=tf.train.latest_checkpoint(model_dir),
+            global_step=global_step,
+            scores=scores
+        )
+
+    def evaluate_continuously(self, model_dir, config, num_workers=4, timeout=None):
+        ''' Watches model_dir and scores every new checkpoint in this (non-training) process.
+            Results go to eval/results.csv and TensorBoard, already scored checkpoints are skipped.
+        '''
+        inception_outputs = self.inception_outputs()
+
+        saver = tf.train.Saver()
+        local_init_op = tf.group(
+            tf.local_variables_initializer(),
+            tf.tables_initializer()
+        )
+
+        eval_dir = os.path.join(model_dir, "eval")
+        results = ResultsTable(os.path.join(eval_dir, "results.csv"))
+        summary_writer = tf.summary.FileWriter(eval_dir)
+
+        for checkpoint in tf.contrib.training.checkpoints_iterator(model_dir, timeout=timeout):
+
+            if checkpoint in results:
+                tf.logging.info("skipping already evaluated checkpoint: {}".format(checkpoint))
+                continue
+
+            with tf.Session(config=config) as session:
+                session.run(local_init_op)
+                saver.restore(session, checkpoint)
+                global_step = session.run(tf.train.get_global_step())
+                scores = self.score(session, inception_outputs, num_workers)
+
+            tf.logging.info("{} (global_step = {}): {}".format(checkpoint, global_step, scores))
+
+            results.append(checkpoint, global_step, scores)
+            summary_writer.add_summary(tf.Summary(value=[
+                tf.Summary.Value(tag=name, simple_value=value)
+                for name, value in scores.items()
+            ]), global_step)
+            summary_writer.flush()
+
+
+class ResultsTable(object):
+    ''' Per-checkpoint metrics appended to a csv file. '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fieldnames = []
+        self.rows = []
+        if os.path.exists(filename):
+            with open(filename) as file:
+                reader = csv.DictReader(file)
+                self.rows = list(reader)
+                self.fieldnames = reader.fieldnames or []
+
+    def __contains__(self, checkpoint):
+        return any(row["checkpoint"] == os.path.basename(checkpoint) for row in self.rows)
 
-            frechet_inception_distance = metrics.frechet_inception_distance(*map(np.concatenate, zip(*generator())))
-            tf.logging.info("frechet_inception_distance: {}".format(frechet_inception_distance))
+    def append(self, checkpoint, global_step, scores):
+        row = dict(checkpoint=os.path.basename(checkpoint), global_step=global_step, **scores)
+        self.rows.append(row)
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        if all(name in self.fieldnames for name in row):
+            with open(self.filename, "a") as file:
+                csv.DictWriter(file, fieldnames=self.fieldnames).writerow(row)
+        else:
+            # new metric columns, rewrite the whole table
+            self.fieldnames += [name for name in row if name not in self.fieldnames]
+            with open(self.filename, "w") as file:
+                writer = csv.DictWriter(file, fieldnames=self.fieldnames)
+                writer.writeheader()
+                writer.writerows(self.rows)
@@ -1,20 +1,47 @@
 import tensorflow as tf
 import numpy as np
+import numbers
 from ops import *
 
 
+# python numbers (a fixed growing or switching level) are folded at graph construction,
+# so static graphs contain only the branches that are actually taken
+
+
 def log(x, base):
+    if isinstance(x, numbers.Real):
+        return np.log(x) / np.log(base)
     return tf.log(x) / tf.log(base)
 
 
+def greater(x, y):
+    if isinstance(x, numbers.Real) and isinstance(y, numbers.Real):
+        return x > y
+    return tf.greater(x, y)
+
+
+def less(x, y):
+    if isinstance(x, numbers.Real) and isinstance(y, numbers.Real):
+        return x < y
+    return tf.less(x, y)
+
+
+def cond(pred, true_fn, false_fn):
+    if isinstance(pred, (bool, np.bool_)):
+        return true_fn() if pred else false_fn()
+    return tf.cond(pred=pred, true_fn=true_fn, false_fn=false_fn)
+
+
 def lerp(a, b, t):
     return t * a + (1 - t) * b
 
 
 class StyleGAN(object):
 
+    # images are NCHW at the interface in either data_format,
+    # data_format="NHWC" runs the networks on stock CPU kernels (which don't support NCHW)
     def __init__(self, min_resolution, max_resolution, min_channels, max_channels,
-                 mapping_layers, growing_level, switching_level):
+                 mapping_layers, growing_level, switching_level, data_format="NCHW"):
 
         self.min_resolution = np.asanyarray(min_resolution)
         self.max_resolution = np.asanyarray(max_resolution)
@@ -23,6 +50,7 @@ class StyleGAN(object):
         self.mapping_layers = mapping_layers
         self.growing_level = growing_level
         self.switching_level = switching_level
+        self.data_format = data_format
 
         def log2(x): return 0 if (x == 1).all() else 1 + log2(x >> 1)
 
@@ -30,216 +58,247 @@ class StyleGAN(object):
         self.max_depth = log2(self.max_resolution // self.min_resolution)
 
         self.growing_depth = log(1 + ((1 << (self.max_depth + 1)) - 1) * self.growing_level, 2.0)
-        self.switching_depth = tf.cast(tf.cast(self.max_depth, tf.float32) * self.switching_level, tf.int32)
+        if isinstance(self.switching_level, numbers.Real):
+            self.switching_depth = int(self.max_depth * self.switching_level)
+        else:
+            self.switching_depth = tf.cast(tf.cast(self.max_depth, tf.float32) * self.switching_level, tf.int32)
 
-    def generator(self, high_latents, low_latents, labels=None, name="generator", reuse=None):
+    def generator(self, high_latents, low_latents, labels=None, truncation=None, name="generator", reuse=None):
 
-        def mapping_network(latents, labels, reuse=tf.AUTO_REUSE):
-            with tf.variable_scope("mapping_network", reuse=reuse):
-                if labels:
-                    labels = embedding(
-                        inputs=labels,
-                        units=latents.shape[1],
-                        variance_scale=1,
-                        scale_weight=True
-                    )
-                    latents = tf.concat([latents, labels], axis=1)
-                latents = pixel_norm(latents)
-                for i in range(self.mapping_layers):
-                    with tf.variable_scope("dense_block_{}".format(i)):
-                        with tf.variable_scope("dense".format(i)):
-                            latents = dense(
-                                inputs=latents,
-                                units=latents.shape[1],
-                                use_bias=True,
-                                variance_scale=2,
-                                scale_weight=True
-                            )
-                        latents = tf.nn.leaky_relu(latents)
-                return latents
+        with tf.variable_scope(name, reuse=reuse):
+            high_latents = self.mapping_network(high_latents, labels)
+            low_latents = self.mapping_network(low_latents, labels)
+            images = self.systhesis_network(high_latents, low_latents, truncation)
+            return images
 
-        def systhesis_network(high_level_latents, low_level_latents, reuse=tf.AUTO_REUSE):
+    # NOTE: mapping_network and systhesis_network have to be called in the generator's variable scope
+    def mapping_network(self, latents, labels=None, reuse=tf.AUTO_REUSE):
+        with tf.variable_scope("mapping_network", reuse=reuse):
+            if labels:
+                labels = embedding(
+                    inputs=labels,
+                    units=latents.shape[1],
+                    variance_scale=1,
+                    scale_weight=True
+                )
+                latents = tf.concat([latents, labels], axis=1)
+            latents = pixel_norm(latents)
+            for i in range(self.mapping_layers):
+                with tf.variable_scope("dense_block_{}".format(i)):
+                    with tf.variable_scope("dense".format(i)):
+                        latents = dense(
+                            inputs=latents,
+                            units=latents.shape[1],
+                            use_bias=True,
+                            variance_scale=2,
+                            scale_weight=True
+                        )
+                    latents = tf.nn.leaky_relu(latents)
+            return latents
 
-            def resolution(depth):
-                return self.min_resolution << depth
+    def systhesis_network(self, high_level_latents, low_level_latents, truncation=None, switching_depth=None,
+                          reuse=tf.AUTO_REUSE):
 
-            def channels(depth):
-                return min(self.max_channels, self.min_channels << (self.max_depth - depth))
+        # switching_depth overrides self.switching_depth, a vector gives each sample its own crossover depth
+        if switching_depth is None:
+            switching_depth = self.switching_depth
+
+        def resolution(depth):
+            return self.min_resolution << depth
+
+        def channels(depth):
+            return min(self.max_channels, self.min_channels << (self.max_depth - depth))
 
-            def latents(depth):
-                return tf.cond(
-                    pred=tf.less(depth, self.switching_depth),
+        def latents(depth):
+            if isinstance(switching_depth, tf.Tensor) and switching_depth.shape.ndims == 1:
+                latents = tf.where(
+                    condition=tf.less(depth, switching_depth),
+                    x=high_level_latents,
+                    y=low_level_latents
+                )
+            else:
+                latents = cond(
+                    pred=less(depth, switching_depth),
                     true_fn=lambda: high_level_latents,
                     false_fn=lambda: low_level_latents
                 )
+            # truncation trick in W (per layer up to cutoff_depth)
+            # truncation = Struct(average_latents=..., psi=..., cutoff_depth=...)
+            if truncation is not None and depth < truncation.cutoff_depth:
+                latents = lerp(
+                    a=latents,
+                    b=tf.cast(truncation.average_latents, tf.float32),
+                    t=truncation.psi
+                )
+            return latents
 
-            def conv_block(inputs, depth, reuse=tf.AUTO_REUSE):
-                with tf.variable_scope("conv_block_{}x{}".format(*resolution(depth)), reuse=reuse):
-                    if depth == self.min_depth:
-                        # learned constant input
-                        with tf.variable_scope("const"):
-                            const = tf.get_variable(
-                                name="const",
-                                shape=[1, channels(depth), *resolution(depth)]
-                            )
-                            inputs = tf.tile(const, [tf.shape(latents(depth))[0], 1, 1, 1])
-                            # apply learned per-channel scaling factors to the noise input
-                            with tf.variable_scope("apply_noise"):
-                                inputs = apply_noise(inputs)
-                            inputs = tf.nn.leaky_relu(inputs)
-                            # inputs = pixel_norm(inputs)
-                            # adaptive instance normalization (AdaIN)
-                            with tf.variable_scope("adaptive_instance_norm"):
-                                inputs = adaptive_instance_norm(
-                                    inputs=inputs,
-                                    latents=latents(depth),
-                                    use_bias=True,
-                                    variance_scale=1,
-                                    scale_weight=True
-                                )
-                        with tf.variable_scope("conv"):
-                            inputs = conv2d(
+        def conv_block(inputs, depth, reuse=tf.AUTO_REUSE):
+            with tf.variable_scope("conv_block_{}x{}".format(*resolution(depth)), reuse=reuse):
+                if depth == self.min_depth:
+                    # learned constant input
+                    with tf.variable_scope("const"):
+                        const = tf.get_variable(
+                            name="const",
+                            shape=[1, channels(depth), *resolution(depth)]
+                        )
+                        if self.data_format == "NHWC":
+                            const = tf.transpose(const, [0, 2, 3, 1])
+                        inputs = tf.tile(const, [tf.shape(latents(depth))[0], 1, 1, 1])
+                        # apply learned per-channel scaling factors to the noise input
+                        with tf.variable_scope("apply_noise"):
+                            inputs = apply_noise(inputs)
+                        inputs = tf.nn.leaky_relu(inputs)
+                        # inputs = pixel_norm(inputs)
+                        # adaptive instance normalization (AdaIN)
+                        with tf.variable_scope("adaptive_instance_norm"):
+                            inputs = adaptive_instance_norm(
                                 inputs=inputs,
-                                filters=channels(depth),
-                                kernel_size=[3, 3],
+                                latents=latents(depth),
                                 use_bias=True,
-                                variance_scale=2,
+                                variance_scale=1,
                                 scale_weight=True
                             )
-                            # apply learned per-channel scaling factors to the noise input
-                            with tf.variable_scope("apply_noise"):
-                                inputs = apply_noise(inputs)
-                            inputs = tf.nn.leaky_relu(inputs)
-                            # inputs = pixel_norm(inputs)
-                            # adaptive instance normalization (AdaIN)
-                            with tf.variable_scope("adaptive_instance_norm"):
-                                inputs = adaptive_instance_norm(
-                                    inputs=inputs,
-                                    latents=latents(depth),
-                                    use_bias=True,
-                                    variance_scale=1,
-                                    scale_weight=True
-                                )
-                        return inputs
-                    else:
-                        with tf.variable_scope("upscale_conv"):
-                            inputs = conv2d_transpose(
+                    with tf.variable_scope("conv"):
+                        inputs = conv2d(
+                            inputs=inputs,
+                            filters=channels(depth),
+                            kernel_size=[3, 3],
+                            use_bias=True,
+                            variance_scale=2,
+                            scale_weight=True
+                        )
+                        # apply learned per-channel scaling factors to the noise input
+                        with tf.variable_scope("apply_noise"):
+                            inputs = apply_noise(inputs)
+                        inputs = tf.nn.leaky_relu(inputs)
+                        # inputs = pixel_norm(inputs)
+                        # adaptive instance normalization (AdaIN)
+                        with tf.variable_scope("adaptive_instance_norm"):
+                            inputs = adaptive_instance_norm(
                                 inputs=inputs,
-                                filters=channels(depth),
-                                kernel_size=[3, 3],
-                                strides=[2, 2],
+                                latents=latents(depth),
                                 use_bias=True,
-                                variance_scale=2,
+                                variance_scale=1,
                                 scale_weight=True
                             )
-                            # apply learned per-channel scaling factors to the noise input
-                            with tf.variable_scope("apply_noise"):
-                                inputs = apply_noise(inputs)
-                            inputs = tf.nn.leaky_relu(inputs)
-                            # inputs = pixel_norm(inputs)
-                            # adaptive instance normalization (AdaIN)
-                            with tf.variable_scope("adaptive_instance_norm"):
-                                inputs = adaptive_instance_norm(
-                                    inputs=inputs,
-                                    latents=latents(depth),
-                                    use_bias=True,
-                                    variance_scale=1,
-                                    scale_weight=True
-                                )
-                        with tf.variable_scope("conv"):
-                            inputs = conv2d(
+                    return inputs
+                else:
+                    with tf.variable_scope("upscale_conv"):
+                        inputs = conv2d_transpose(
+                            inputs=inputs,
+                            filters=channels(depth),
+                            kernel_size=[3, 3],
+                            strides=[2, 2],
+                            use_bias=True,
+                            variance_scale=2,
+                            scale_weight=True
+                        )
+                        # apply learned per-channel scaling factors to the noise input
+                        with tf.variable_scope("apply_noise"):
+                            inputs = apply_noise(inputs)
+                        inputs = tf.nn.leaky_relu(inputs)
+                        # inputs = pixel_norm(inputs)
+                        # adaptive instance normalization (AdaIN)
+                        with tf.variable_scope("adaptive_instance_norm"):
+                            inputs = adaptive_instance_norm(
                                 inputs=inputs,
-                                filters=channels(depth),
-                                kernel_size=[3, 3],
+                                latents=latents(depth),
                                 use_bias=True,
-                                variance_scale=2,
+                                variance_scale=1,
                                 scale_weight=True
                             )
-                            # apply learned per-channel scaling factors to the noise input
-                            with tf.variable_scope("apply_noise"):
-                                inputs = apply_noise(inputs)
-                            inputs = tf.nn.leaky_relu(inputs)
-                            # inputs = pixel_norm(inputs)
-                            # adaptive instance normalization (AdaIN)
-                            with tf.variable_scope("adaptive_instance_norm"):
-                                inputs = adaptive_instance_norm(
-                                    inputs=inputs,
-                                    latents=latents(depth),
-                                    use_bias=True,
-                                    variance_scale=1,
-                                    scale_weight=True
-                                )
-                        return inputs
-
-            def color_block(inputs, depth, reuse=tf.AUTO_REUSE):
-                with tf.variable_scope("color_block_{}x{}".format(*resolution(depth)), reuse=reuse):
                     with tf.variable_scope("conv"):
                         inputs = conv2d(
                             inputs=inputs,
-                            filters=3,
-                            kernel_size=[1, 1],
+                            filters=channels(depth),
+                            kernel_size=[3, 3],
                             use_bias=True,
-                            variance_scale=1,
+                            variance_scale=2,
                             scale_weight=True
                         )
-                        # linear activation
-                        # inputs = tf.nn.tanh(inputs)
+                        # apply learned per-channel scaling factors to the noise input
+                        with tf.variable_scope("apply_noise"):
+                            inputs = apply_noise(inputs)
+                        inputs = tf.nn.leaky_relu(inputs)
+                        # inputs = pixel_norm(inputs)
+                        # adaptive instance normalization (AdaIN)
+                        with tf.variable_scope("adaptive_instance_norm"):
+                            inputs = adaptive_instance_norm(
+                                inputs=inputs,
+                                latents=latents(depth),
+                                use_bias=True,
+                                variance_scale=1,
+                                scale_weight=True
+                            )
                     return inputs
 
-            def grow(feature_maps, depth):
+        def color_block(inputs, depth, reuse=tf.AUTO_REUSE):
+            with tf.variable_scope("color_block_{}x{}".format(*resolution(depth)), reuse=reuse):
+                with tf.variable_scope("conv"):
+                    inputs = conv2d(
+                        inputs=inputs,
+                        filters=3,
+                        kernel_size=[1, 1],
+                        use_bias=True,
+                        variance_scale=1,
+                        scale_weight=True
+                    )
+                    # linear activation
+                    # inputs = tf.nn.tanh(inputs)
+                return inputs
 
-                def high_resolution_images():
-                    return grow(conv_block(feature_maps, depth), depth + 1)
+        def grow(feature_maps, depth):
 
-                def middle_resolution_images():
-                    return upscale2d(
-                        inputs=color_block(conv_block(feature_maps, depth), depth),
-                        factors=resolution(self.max_depth) // resolution(depth)
-                    )
+            def high_resolution_images():
+                return grow(conv_block(feature_maps, depth), depth + 1)
 
-                def low_resolution_images():
-                    return upscale2d(
-                        inputs=color_block(feature_maps, depth - 1),
-                        factors=resolution(self.max_depth) // resolution(depth - 1)
-                    )
+            def middle_resolution_images():
+                return upscale2d(
+                    inputs=color_block(conv_block(feature_maps, depth), depth),
+                    factors=resolution(self.max_depth) // resolution(depth)
+                )
 
-                if depth == self.min_depth:
-                    images = tf.cond(
-                        pred=tf.greater(self.growing_depth, depth),
-                        true_fn=high_resolution_images,
-                        false_fn=middle_resolution_images
-                    )
-                elif depth == self.max_depth:
-                    images = tf.cond(
-                        pred=tf.greater(self.growing_depth, depth),
-                        true_fn=middle_resolution_images,
-                        false_fn=lambda: lerp(
-                            a=low_resolution_images(),
-                            b=middle_resolution_images(),
-                            t=depth - self.growing_depth
-                        )
+            def low_resolution_images():
+                return upscale2d(
+                    inputs=color_block(feature_maps, depth - 1),
+                    factors=resolution(self.max_depth) // resolution(depth - 1)
+                )
+
+            if depth == self.min_depth:
+                images = cond(
+                    pred=greater(self.growing_depth, depth),
+                    true_fn=high_resolution_images,
+                    false_fn=middle_resolution_images
+                )
+            elif depth == self.max_depth:
+                images = cond(
+                    pred=greater(self.growing_depth, depth),
+                    true_fn=middle_resolution_images,
+                    false_fn=lambda: lerp(
+                        a=low_resolution_images(),
+                        b=middle_resolution_images(),
+                        t=depth - self.growing_depth
                     )
-                else:
-                    images = tf.cond(
-                        pred=tf.greater(self.growing_depth, depth),
-                        true_fn=high_resolution_images,
-                        false_fn=lambda: lerp(
-                            a=low_resolution_images(),
-                            b=middle_resolution_images(),
-                            t=depth - self.growing_depth
-                        )
+                )
+            else:
+                images = cond(
+                    pred=greater(self.growing_depth, depth),
+                    true_fn=high_resolution_images,
+                    false_fn=lambda: lerp(
+                        a=low_resolution_images(),
+                        b=middle_resolution_images(),
+                        t=depth - self.growing_depth
                     )
-                return images
-
-            with tf.variable_scope("systhesis_network", reuse=reuse):
-                return grow(None, self.min_depth)
-
-        with tf.variable_scope(name, reuse=reuse):
-            high_latents = mapping_network(high_latents, labels)
-            low_latents = mapping_network(low_latents, labels)
-            images = systhesis_network(high_latents, low_latents)
+                )
             return images
 
+        with tf.variable_scope("systhesis_network", reuse=reuse):
+            with tf.contrib.framework.arg_scope(DATA_FORMAT_OPS, data_format=self.data_format):
+                images = grow(None, self.min_depth)
+                if self.data_format == "NHWC":
+                    images = tf.transpose(images, [0, 3, 1, 2])
+                return images
+
     def discriminator(self, images, labels=None, name="discriminator", reuse=None):
 
         def resolution(depth):
@@ -251,7 +310,7 @@ class StyleGAN(object):
         def conv_block(inputs, depth, reuse=tf.AUTO_REUSE):
             with tf.variable_scope("conv_block_{}x{}".format(*resolution(depth)), reuse=reuse):
                 if depth == self.min_depth:
-                    inputs = tf.concat([inputs, batch_stddev(inputs)], axis=1)
+                    inputs = tf.concat([inputs, batch_stddev(inputs)], axis=channel_axis(self.data_format))
                     with tf.variable_scope("conv"):
                         inputs = conv2d(
                             inputs=inputs,
@@ -263,6 +322,9 @@ class StyleGAN(object):
                         )
                         inputs = tf.nn.leaky_relu(inputs)
                     with tf.variable_scope("dense"):
+                        # flattened in NCHW order for the same dense weights in either data_format
+                        if self.data_format == "NHWC":
+                            inputs = tf.transpose(inputs, [0, 3, 1, 2])
                         inputs = tf.layers.flatten(inputs)
                         inputs = dense(
                             inputs=inputs,
@@ -353,14 +415,14 @@ class StyleGAN(object):
                 ), depth - 1)
 
             if depth == self.min_depth:
-                feature_maps = tf.cond(
-                    pred=tf.greater(self.growing_depth, depth),
+                feature_maps = cond(
+                    pred=greater(self.growing_depth, depth),
                     true_fn=high_resolution_feature_maps,
                     false_fn=middle_resolution_feature_maps
                 )
             elif depth == self.max_depth:
-                feature_maps = tf.cond(
-                    pred=tf.greater(self.growing_depth, depth),
+                feature_maps = cond(
+                    pred=greater(self.growing_depth, depth),
                     true_fn=middle_resolution_feature_maps,
                     false_fn=lambda: lerp(
                         a=low_resolution_feature_maps(),
@@ -369,8 +431,8 @@ class StyleGAN(object):
                     )
                 )
             else:
-                feature_maps = tf.cond(
-                    pred=tf.greater(self.growing_depth, depth),
+                feature_maps = cond(
+                    pred=greater(self.growing_depth, depth),
                     true_fn=high_resolution_feature_maps,
                     false_fn=lambda: lerp(
                         a=low_resolution_feature_maps(),
@@ -381,4 +443,7 @@ class StyleGAN(object):
             return feature_maps
 
         with tf.variable_scope(name, reuse=reuse):
-            return grow(images, self.min_depth)
+            with tf.contrib.framework.arg_scope(DATA_FORMAT_OPS, data_format=self.data_format):
+                if self.data_format == "NHWC":
+                    images = tf.transpose(images, [0, 2, 3, 1])
+                return grow(images, self.min_depth)
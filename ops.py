@@ -1,5 +1,46 @@
 import tensorflow as tf
 import numpy as np
+import zlib
+
+# every op on feature maps takes data_format="NCHW" (GPU) or "NHWC" (stock CPU kernels),
+# set it for the whole network with arg_scope(DATA_FORMAT_OPS, data_format=...)
+
+
+def channel_axis(data_format):
+    return 1 if data_format == "NCHW" else 3
+
+
+def spatial_axes(data_format):
+    return [2, 3] if data_format == "NCHW" else [1, 2]
+
+
+def spatial_shape(inputs, data_format):
+    return np.array(inputs.shape[2:] if data_format == "NCHW" else inputs.shape[1:3])
+
+
+def channel_shape(shape, data_format):
+    # [batch, channels, height, width] or [batch, height, width, channels] for per-channel values
+    return [shape[0], shape[1], *shape[2:]] if data_format == "NCHW" else [shape[0], *shape[2:], shape[1]]
+
+
+def to_int64(value):
+    # wraps a python integer to the range of int64
+    value &= (1 << 64) - 1
+    return value - (1 << 64) if value >> 63 else value
+
+
+def hash_sample_ids(sample_ids, seed):
+    ''' splitmix64 of sample_ids in the stream of seed (int64 arithmetic wraps around),
+        every bit of the result depends on every bit of the sample id.
+    '''
+    def logical_right_shift(inputs, shift):
+        return tf.bitwise.bitwise_and(tf.bitwise.right_shift(inputs, shift), (1 << (64 - shift)) - 1)
+
+    inputs = tf.cast(sample_ids, tf.int64) + to_int64((seed + 1) * 0x9E3779B97F4A7C15)
+    inputs = tf.bitwise.bitwise_xor(inputs, logical_right_shift(inputs, 30)) * to_int64(0xBF58476D1CE4E5B9)
+    inputs = tf.bitwise.bitwise_xor(inputs, logical_right_shift(inputs, 27)) * to_int64(0x94D049BB133111EB)
+    inputs = tf.bitwise.bitwise_xor(inputs, logical_right_shift(inputs, 31))
+    return inputs
 
 
 def get_weight(shape, variance_scale=2, scale_weight=False):
@@ -41,72 +82,88 @@ def dense(inputs, units, use_bias=True, variance_scale=2, scale_weight=False):
     return inputs
 
 
+@tf.contrib.framework.add_arg_scope
 def conv2d(inputs, filters, kernel_size, strides=[1, 1], use_bias=True,
-           variance_scale=2, scale_weight=True):
-    weight = get_weight(
-        shape=[*kernel_size, inputs.shape[1].value, filters],
-        variance_scale=variance_scale,
-        scale_weight=scale_weight
-    )
-    inputs = tf.nn.conv2d(
-        input=inputs,
-        filter=weight,
-        strides=[1, 1] + strides,
-        padding="SAME",
-        data_format="NCHW"
-    )
+           variance_scale=2, scale_weight=True, quantizer=None, data_format="NCHW"):
+    # quantizer replaces the convolution (see quantization.py),
+    # set it for the whole network with arg_scope([conv2d, conv2d_transpose], quantizer=...)
+    if quantizer:
+        inputs = quantizer.conv2d(inputs, filters, kernel_size, strides, variance_scale, scale_weight, data_format)
+    else:
+        weight = get_weight(
+            shape=[*kernel_size, inputs.shape[channel_axis(data_format)].value, filters],
+            variance_scale=variance_scale,
+            scale_weight=scale_weight
+        )
+        inputs = tf.nn.conv2d(
+            input=inputs,
+            filter=weight,
+            strides=channel_shape([1, 1, *strides], data_format),
+            padding="SAME",
+            data_format=data_format
+        )
     if use_bias:
-        bias = get_bias([inputs.shape[1].value])
-        inputs = tf.nn.bias_add(inputs, bias, data_format="NCHW")
+        bias = get_bias([inputs.shape[channel_axis(data_format)].value])
+        inputs = tf.nn.bias_add(inputs, bias, data_format=data_format)
     return inputs
 
 
+@tf.contrib.framework.add_arg_scope
 def conv2d_transpose(inputs, filters, kernel_size, strides=[1, 1], use_bias=True,
-                     variance_scale=2, scale_weight=True):
-    weight = get_weight(
-        shape=[*kernel_size, inputs.shape[1].value, filters],
-        variance_scale=variance_scale,
-        scale_weight=scale_weight
-    )
-    weight = tf.transpose(weight, [0, 1, 3, 2])
-    input_shape = np.array(inputs.shape)
-    output_shape = [tf.shape(inputs)[0], filters, *input_shape[2:] * strides]
-    inputs = tf.nn.conv2d_transpose(
-        value=inputs,
-        filter=weight,
-        output_shape=output_shape,
-        strides=[1, 1] + strides,
-        padding="SAME",
-        data_format="NCHW"
-    )
+                     variance_scale=2, scale_weight=True, quantizer=None, data_format="NCHW"):
+    if quantizer:
+        inputs = quantizer.conv2d_transpose(inputs, filters, kernel_size, strides, variance_scale, scale_weight, data_format)
+    else:
+        weight = get_weight(
+            shape=[*kernel_size, inputs.shape[channel_axis(data_format)].value, filters],
+            variance_scale=variance_scale,
+            scale_weight=scale_weight
+        )
+        weight = tf.transpose(weight, [0, 1, 3, 2])
+        output_shape = channel_shape([tf.shape(inputs)[0], filters, *spatial_shape(inputs, data_format) * strides], data_format)
+        inputs = tf.nn.conv2d_transpose(
+            value=inputs,
+            filter=weight,
+            output_shape=output_shape,
+            strides=channel_shape([1, 1, *strides], data_format),
+            padding="SAME",
+            data_format=data_format
+        )
     if use_bias:
-        bias = get_bias([inputs.shape[1].value])
-        inputs = tf.nn.bias_add(inputs, bias, data_format="NCHW")
+        bias = get_bias([inputs.shape[channel_axis(data_format)].value])
+        inputs = tf.nn.bias_add(inputs, bias, data_format=data_format)
     return inputs
 
 
-def upscale2d(inputs, factors=[2, 2]):
+@tf.contrib.framework.add_arg_scope
+def upscale2d(inputs, factors=[2, 2], data_format="NCHW"):
     factors = np.asanyarray(factors)
     if (factors == 1).all():
         return inputs
     shape = inputs.shape
-    inputs = tf.reshape(inputs, [-1, shape[1], shape[2], 1, shape[3], 1])
-    inputs = tf.tile(inputs, [1, 1, 1, factors[0], 1, factors[1]])
-    inputs = tf.reshape(inputs, [-1, shape[1], shape[2] * factors[0], shape[3] * factors[1]])
+    if data_format == "NCHW":
+        inputs = tf.reshape(inputs, [-1, shape[1], shape[2], 1, shape[3], 1])
+        inputs = tf.tile(inputs, [1, 1, 1, factors[0], 1, factors[1]])
+        inputs = tf.reshape(inputs, [-1, shape[1], shape[2] * factors[0], shape[3] * factors[1]])
+    else:
+        inputs = tf.reshape(inputs, [-1, shape[1], 1, shape[2], 1, shape[3]])
+        inputs = tf.tile(inputs, [1, 1, factors[0], 1, factors[1], 1])
+        inputs = tf.reshape(inputs, [-1, shape[1] * factors[0], shape[2] * factors[1], shape[3]])
     return inputs
 
 
-def downscale2d(inputs, factors=[2, 2]):
+@tf.contrib.framework.add_arg_scope
+def downscale2d(inputs, factors=[2, 2], data_format="NCHW"):
     # NOTE: requires tf_config["graph_options.place_pruned_graph"] = True
     factors = np.asanyarray(factors)
     if (factors == 1).all():
         return inputs
     inputs = tf.nn.avg_pool(
         value=inputs,
-        ksize=[1, 1, *factors],
-        strides=[1, 1, *factors],
+        ksize=channel_shape([1, 1, *factors], data_format),
+        strides=channel_shape([1, 1, *factors], data_format),
         padding="SAME",
-        data_format="NCHW"
+        data_format=data_format
     )
     return inputs
 
@@ -126,40 +183,43 @@ def pixel_norm(inputs, epsilon=1e-8):
     return inputs
 
 
-def batch_stddev(inputs, group_size=4, epsilon=1e-8):
+@tf.contrib.framework.add_arg_scope
+def batch_stddev(inputs, group_size=4, epsilon=1e-8, data_format="NCHW"):
     shape = inputs.shape
+    spatial = spatial_shape(inputs, data_format)
     inputs = tf.reshape(inputs, [group_size, -1, *shape[1:]])
     inputs -= tf.reduce_mean(inputs, axis=0, keepdims=True)
     inputs = tf.square(inputs)
     inputs = tf.reduce_mean(inputs, axis=0)
     inputs = tf.sqrt(inputs + epsilon)
     inputs = tf.reduce_mean(inputs, axis=[1, 2, 3], keepdims=True)
-    inputs = tf.tile(inputs, [group_size, 1, *shape[2:]])
+    inputs = tf.tile(inputs, channel_shape([group_size, 1, *spatial], data_format))
     return inputs
 
 
+@tf.contrib.framework.add_arg_scope
 def adaptive_instance_norm(inputs, latents, use_bias=True, center=True, scale=True,
-                           variance_scale=2, scale_weight=True, epsilon=1e-8):
+                           variance_scale=2, scale_weight=True, epsilon=1e-8, data_format="NCHW"):
     ''' Adaptive Instance Normalization
         [Arbitrary Style Transfer in Real-time with Adaptive Instance Normalization]
         (https://arxiv.org/pdf/1703.06868.pdf)
     '''
     # standard instance normalization
-    inputs -= tf.reduce_mean(inputs, axis=[2, 3], keepdims=True)
-    inputs *= tf.rsqrt(tf.reduce_mean(tf.square(inputs), axis=[2, 3], keepdims=True) + epsilon)
+    inputs -= tf.reduce_mean(inputs, axis=spatial_axes(data_format), keepdims=True)
+    inputs *= tf.rsqrt(tf.reduce_mean(tf.square(inputs), axis=spatial_axes(data_format), keepdims=True) + epsilon)
 
     if scale:
         with tf.variable_scope("scale"):
             gamma = dense(
                 inputs=latents,
-                units=inputs.shape[1],
+                units=inputs.shape[channel_axis(data_format)],
                 use_bias=use_bias,
                 variance_scale=variance_scale,
                 scale_weight=scale_weight
             )
             gamma = tf.reshape(
                 tensor=gamma,
-                shape=[-1, gamma.shape[1], 1, 1]
+                shape=channel_shape([-1, gamma.shape[1], 1, 1], data_format)
             )
         inputs *= gamma
 
@@ -167,27 +227,77 @@ def adaptive_instance_norm(inputs, latents, use_bias=True, center=True, scale=Tr
         with tf.variable_scope("center"):
             beta = dense(
                 inputs=latents,
-                units=inputs.shape[1],
+                units=inputs.shape[channel_axis(data_format)],
                 use_bias=use_bias,
                 variance_scale=variance_scale,
                 scale_weight=scale_weight
             )
             beta = tf.reshape(
                 tensor=beta,
-                shape=[-1, beta.shape[1], 1, 1]
+                shape=channel_shape([-1, beta.shape[1], 1, 1], data_format)
             )
         inputs += beta
 
     return inputs
 
 
-def apply_noise(inputs):
-    noise = tf.random_normal([tf.shape(inputs)[0], 1, *inputs.shape[2:]])
+@tf.contrib.framework.add_arg_scope
+def apply_noise(inputs, noise_fn=None, noise_mode="random", sample_ids=None, noise_bank_size=64, data_format="NCHW"):
+    ''' noise_mode:
+        "random": fresh noise on every forward pass
+        "static": one pre-allocated noise map per layer shared by all samples
+        "seeded": per-sample noise gathered from a pre-allocated per-layer bank of noise_bank_size maps
+                  by a hash of sample_ids (reproducible)
+        "zero": no noise, the op is skipped
+        noise_fn(shape) can supply the noise instead (e.g. optimized noise maps),
+        set either for the whole network with arg_scope([apply_noise], ...)
+    '''
+    if noise_mode == "zero" and not noise_fn:
+        return inputs
+    shape = channel_shape([tf.shape(inputs)[0], 1, *spatial_shape(inputs, data_format)], data_format)
+    # stable per-layer seed
+    layer_seed = zlib.crc32(tf.get_variable_scope().name.encode()) & 0x7fffffff
+    if noise_fn:
+        noise = noise_fn(shape)
+    elif noise_mode == "random":
+        noise = tf.random_normal(shape)
+    elif noise_mode == "static":
+        noise = tf.get_variable(
+            name="static_noise",
+            shape=[1, *shape[1:]],
+            initializer=tf.initializers.random_normal(seed=layer_seed),
+            trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES]
+        )
+    elif noise_mode == "seeded":
+        noise_bank = tf.get_variable(
+            name="noise_bank",
+            shape=[noise_bank_size, *shape[1:]],
+            initializer=tf.initializers.random_normal(seed=layer_seed),
+            trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES]
+        )
+        # hashed per layer, so that layers pick independent maps for a sample
+        indices = tf.floormod(hash_sample_ids(sample_ids, layer_seed), noise_bank_size)
+        noise = tf.gather(noise_bank, indices)
+    else:
+        raise ValueError("unknown noise mode: {}".format(noise_mode))
     weight = tf.get_variable(
         name="weight",
-        shape=[inputs.shape[1]],
+        shape=[inputs.shape[channel_axis(data_format)]],
         initializer=tf.initializers.zeros()
     )
-    weight = tf.reshape(weight, [1, -1, 1, 1])
+    weight = tf.reshape(weight, channel_shape([1, -1, 1, 1], data_format))
     inputs += noise * weight
     return inputs
+
+
+DATA_FORMAT_OPS = [
+    conv2d,
+    conv2d_transpose,
+    upscale2d,
+    downscale2d,
+    batch_stddev,
+    adaptive_instance_norm,
+    apply_noise
+]
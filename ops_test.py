@@ -0,0 +1,46 @@
+import tensorflow as tf
+import numpy as np
+import zlib
+from ops import hash_sample_ids, apply_noise
+
+
+class ApplyNoiseTest(tf.test.TestCase):
+
+    def test_bank_indices_are_not_periodic(self):
+        noise_bank_size = 64
+        sample_ids = np.arange(4096)
+        layer_seeds = [zlib.crc32("generator/layer_{}".format(i).encode()) & 0x7fffffff for i in range(14)]
+        with self.session() as session:
+            indices = session.run([
+                tf.floormod(hash_sample_ids(sample_ids, layer_seed), noise_bank_size)
+                for layer_seed in layer_seeds
+            ])
+        indices = np.stack(indices, axis=1)
+        # ids k and k + noise_bank_size differ in at least one layer
+        self.assertFalse(np.any(np.all(indices[:-noise_bank_size] == indices[noise_bank_size:], axis=1)))
+        # layers pick independently, so there are far more than noise_bank_size realizations
+        self.assertGreater(len(set(map(tuple, indices))), noise_bank_size * 16)
+
+    def test_seeded_noise_differs_for_ids_a_bank_apart(self):
+        noise_bank_size = 64
+        sample_ids = np.arange(2 * noise_bank_size)
+        inputs = tf.zeros([len(sample_ids), 4, 8, 8])
+        with tf.variable_scope("layer"):
+            outputs = apply_noise(
+                inputs=inputs,
+                noise_mode="seeded",
+                sample_ids=sample_ids,
+                noise_bank_size=noise_bank_size
+            )
+        weight = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="layer/weight")[0]
+        with self.session() as session:
+            session.run(tf.local_variables_initializer())
+            session.run(weight.assign(tf.ones_like(weight)))
+            outputs = session.run(outputs)
+        # at most a few collisions of a single layer (about 1 / noise_bank_size)
+        different = np.any(outputs[:noise_bank_size] != outputs[noise_bank_size:], axis=(1, 2, 3))
+        self.assertGreater(np.mean(different), 0.9)
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -0,0 +1,187 @@
+import tensorflow as tf
+import numpy as np
+import collections
+import os
+from ops import apply_noise
+
+
+class Projector(object):
+    ''' Embeds batches of real images into the generator's latent space
+        by optimizing a W latent and the noise maps per image.
+        [A Style-Based Generator Architecture for Generative Adversarial Networks]
+        (https://arxiv.org/pdf/1812.04948.pdf)
+    '''
+
+    def __init__(self, style_gan, num_images, image_size, latent_size=512, loss="perceptual",
+                 learning_rate=0.1, tolerance=1e-3, average_latents=None, num_average_samples=10000,
+                 name="generator"):
+
+        def local_variable(name, initial_value):
+            return tf.Variable(
+                initial_value=initial_value,
+                name=name,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES, "projection_variables"]
+            )
+
+        def decode(filename):
+            image = tf.read_file(filename)
+            image = tf.image.decode_jpeg(image, 3)
+            image = tf.image.convert_image_dtype(image, tf.float32)
+            image = tf.image.resize_images(image, image_size)
+            image = tf.transpose(image, [2, 0, 1])
+            image = (image - 0.5) / 0.5
+            return image
+
+        def perceptual_features(images):
+            images = tf.transpose(images, [0, 2, 3, 1])
+            return tf.contrib.gan.eval.run_inception(
+                images=tf.contrib.gan.eval.preprocess_image(images * 127.5 + 127.5),
+                output_tensor="pool_3:0"
+            )
+
+        # grow traces every block in both branches of its tf.cond,
+        # so apply_noise runs twice per layer and AUTO_REUSE returns the same variable
+        noises = collections.OrderedDict()
+
+        def noise_fn(shape):
+            noise = tf.get_variable(
+                name="noise",
+                shape=[num_images, *shape[1:]],
+                initializer=tf.initializers.random_normal(),
+                collections=[tf.GraphKeys.LOCAL_VARIABLES, "projection_variables"]
+            )
+            noises[noise.op.name] = noise
+            return noise
+
+        # =========================================================================================
+        # per-image W latents start from the center of W
+        with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
+            if average_latents is None:
+                average_latents = tf.reduce_mean(style_gan.mapping_network(
+                    tf.random_normal([num_average_samples, latent_size])
+                ), axis=0)
+            latents = local_variable("latents", tf.tile(
+                tf.reshape(tf.cast(average_latents, tf.float32), [1, latent_size]),
+                [num_images, 1]
+            ))
+            with tf.contrib.framework.arg_scope([apply_noise], noise_fn=noise_fn):
+                images = style_gan.systhesis_network(latents, latents)
+        # only the generator (and the global step driving its growing level) is restored from the checkpoint
+        restored_variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=name)
+        if tf.train.get_global_step() is not None:
+            restored_variables.append(tf.train.get_global_step())
+        # =========================================================================================
+        # target features are computed once per chunk when the projection variables are initialized
+        self.filenames = tf.placeholder(tf.string, [num_images])
+        targets = tf.map_fn(decode, self.filenames, dtype=tf.float32)
+        if loss == "pixel":
+            features = tf.identity
+        elif loss == "perceptual":
+            features = perceptual_features
+        else:
+            raise ValueError("unknown projection loss: {}".format(loss))
+        target_features = local_variable("target_features", features(targets))
+        losses = tf.reduce_mean(tf.square(features(images) - target_features), axis=np.arange(1, target_features.shape.ndims))
+        # =========================================================================================
+        # best latents and noises so far are kept per image, so stopped images are not degraded
+        # by optimizer momentum while the rest of the batch is still being optimized
+        best_losses = local_variable("best_losses", tf.fill([num_images], np.inf))
+        best_latents = local_variable("best_latents", latents.initialized_value())
+        best_noises = collections.OrderedDict(
+            (name, local_variable("best_noise_{}".format(i), noise.initialized_value()))
+            for i, (name, noise) in enumerate(noises.items())
+        )
+        improved = tf.less(losses, best_losses * (1 - tolerance))
+
+        def update_best(best, current):
+            return best.assign(tf.where(improved, current, best))
+
+        update_op = tf.group(
+            update_best(best_losses, losses),
+            update_best(best_latents, latents),
+            *[update_best(best_noises[name], noise) for name, noise in noises.items()]
+        )
+        # =========================================================================================
+        # images which stopped early are masked out of the loss
+        self.active = tf.placeholder(tf.float32, [num_images])
+        optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate)
+        with tf.control_dependencies([update_op]):
+            train_op = optimizer.minimize(
+                loss=tf.reduce_sum(losses * self.active),
+                var_list=[latents, *noises.values()]
+            )
+        # =========================================================================================
+        self.saver = tf.train.Saver(restored_variables)
+        self.num_images = num_images
+        self.losses = losses
+        self.improved = improved
+        self.train_op = train_op
+        self.best_losses = best_losses
+        self.best_latents = best_latents
+        self.best_noises = best_noises
+        self.initializer = tf.variables_initializer([
+            *tf.get_collection("projection_variables"),
+            *optimizer.variables()
+        ])
+
+    def project(self, filenames, output_dir, model_dir, num_steps, patience, config):
+        ''' Projects filenames in chunks of num_images and writes one .npz per image,
+            mirroring the directories of filenames below their common root.
+            Images which already have an output are skipped, so an interrupted run can be resumed.
+        '''
+        if num_steps <= 0:
+            raise ValueError("num_steps ({}) has to be positive".format(num_steps))
+
+        if not filenames:
+            return
+
+        # outputs are keyed by the path below the common root, so equal basenames in different directories don't collide
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(filename)) for filename in filenames])
+
+        def output_filename(filename):
+            relative_filename = os.path.relpath(os.path.abspath(filename), root)
+            return os.path.join(output_dir, "{}.npz".format(os.path.splitext(relative_filename)[0]))
+
+        filenames = [filename for filename in filenames if not os.path.exists(output_filename(filename))]
+
+        with tf.Session(config=config) as session:
+
+            self.saver.restore(session, tf.train.latest_checkpoint(model_dir))
+
+            for begin in range(0, len(filenames), self.num_images):
+
+                chunk = filenames[begin:begin + self.num_images]
+                # the last chunk is padded and the padding is never optimized
+                padded_chunk = chunk + chunk[-1:] * (self.num_images - len(chunk))
+                active = np.arange(self.num_images) < len(chunk)
+                stalls = np.zeros(self.num_images)
+
+                session.run(self.initializer, feed_dict={self.filenames: padded_chunk})
+
+                for step in range(num_steps):
+                    _, improved = session.run(
+                        [self.train_op, self.improved],
+                        feed_dict={self.active: active.astype(np.float32)}
+                    )
+                    stalls = np.where(improved, 0, stalls + 1)
+                    active &= stalls < patience
+                    if not active.any():
+                        break
+
+                losses, latents, noises = session.run([self.best_losses, self.best_latents, self.best_noises])
+
+                for i, filename in enumerate(chunk):
+                    os.makedirs(os.path.dirname(output_filename(filename)), exist_ok=True)
+                    with open("{}.tmp".format(output_filename(filename)), "wb") as file:
+                        np.savez(
+                            file,
+                            loss=losses[i],
+                            latents=latents[i],
+                            # noise maps are saved under the scope of their layer
+                            **{os.path.dirname(name): noise[i] for name, noise in noises.items()}
+                        )
+                    os.replace(file.name, output_filename(filename))
+
+                tf.logging.info("projected {}/{} images (step {}, mean loss {})".format(
+                    begin + len(chunk), len(filenames), step, np.mean(losses[:len(chunk)])
+                ))
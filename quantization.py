@@ -0,0 +1,270 @@
+import tensorflow as tf
+import numpy as np
+import time
+import metrics
+from ops import conv2d, conv2d_transpose, apply_noise, channel_shape, spatial_shape
+from utils import Struct
+
+# Post-training int8 quantization of the generator for CPU serving.
+# conv2d runs as a real quint8 convolution (tf.nn.quantized_conv2d, NHWC) with per-tensor ranges,
+# conv2d_transpose has no quantized kernel and runs in float32 on int8 weights (per output channel)
+# with fake-quantized inputs. Everything else (mapping network, AdaIN, biases, ...) stays float32.
+# The model is built fully grown, without style mixing and with zero noise, so that
+# calibration, inference and the parity report see the same deterministic network.
+# On CPU the style_gan has to be built with data_format="NHWC" (the float reference included).
+
+
+def effective_weight(weight, variance_scale, scale_weight):
+    # see ops.get_weight
+    return weight * np.sqrt(variance_scale / np.prod(weight.shape[:-1])) if scale_weight else weight
+
+
+class Calibrator(object):
+    ''' Float convolutions which record their weights and input ranges. '''
+
+    def __init__(self):
+        self.layers = {}
+
+    def record(self, inputs, variance_scale, scale_weight, transpose):
+        name = tf.get_variable_scope().name
+        weight = [variable for variable in tf.global_variables() if variable.op.name == "{}/weight".format(name)][0]
+        self.layers[name] = Struct(
+            weight=weight,
+            input_min=tf.reduce_min(inputs),
+            input_max=tf.reduce_max(inputs),
+            variance_scale=variance_scale,
+            scale_weight=scale_weight,
+            transpose=transpose
+        )
+
+    def conv2d(self, inputs, filters, kernel_size, strides, variance_scale, scale_weight, data_format="NCHW"):
+        outputs = conv2d(inputs, filters, kernel_size, strides, False, variance_scale, scale_weight,
+                         quantizer=None, data_format=data_format)
+        self.record(inputs, variance_scale, scale_weight, transpose=False)
+        return outputs
+
+    def conv2d_transpose(self, inputs, filters, kernel_size, strides, variance_scale, scale_weight, data_format="NCHW"):
+        outputs = conv2d_transpose(inputs, filters, kernel_size, strides, False, variance_scale, scale_weight,
+                                   quantizer=None, data_format=data_format)
+        self.record(inputs, variance_scale, scale_weight, transpose=True)
+        return outputs
+
+
+class Int8Convolutions(object):
+    ''' Convolutions on the quantized weights of an artifact written by quantize. '''
+
+    def __init__(self, artifact):
+        self.artifact = artifact
+
+    def layer(self, key):
+        return self.artifact["{}/{}".format(tf.get_variable_scope().name, key)]
+
+    def conv2d(self, inputs, filters, kernel_size, strides, variance_scale, scale_weight, data_format="NCHW"):
+        # quantized_conv2d only supports NHWC
+        if data_format == "NCHW":
+            inputs = tf.transpose(inputs, [0, 2, 3, 1])
+        inputs, input_min, input_max = tf.quantization.quantize(
+            input=inputs,
+            min_range=float(self.layer("input_min")),
+            max_range=float(self.layer("input_max")),
+            T=tf.quint8
+        )
+        outputs, output_min, output_max = tf.nn.quantized_conv2d(
+            input=inputs,
+            filter=tf.constant(self.layer("weight_quint8"), dtype=tf.quint8),
+            min_input=input_min,
+            max_input=input_max,
+            min_filter=float(self.layer("weight_min")),
+            max_filter=float(self.layer("weight_max")),
+            strides=[1, *strides, 1],
+            padding="SAME"
+        )
+        outputs = tf.quantization.dequantize(outputs, output_min, output_max)
+        if data_format == "NCHW":
+            outputs = tf.transpose(outputs, [0, 3, 1, 2])
+        return outputs
+
+    def conv2d_transpose(self, inputs, filters, kernel_size, strides, variance_scale, scale_weight, data_format="NCHW"):
+        inputs = tf.quantization.fake_quant_with_min_max_args(
+            inputs=inputs,
+            min=float(self.layer("input_min")),
+            max=float(self.layer("input_max")),
+            num_bits=8
+        )
+        weight = tf.cast(tf.constant(self.layer("weight_int8")), tf.float32) * self.layer("weight_scale")
+        weight = tf.transpose(weight, [0, 1, 3, 2])
+        outputs = tf.nn.conv2d_transpose(
+            value=inputs,
+            filter=weight,
+            output_shape=channel_shape([tf.shape(inputs)[0], filters, *spatial_shape(inputs, data_format) * strides], data_format),
+            strides=channel_shape([1, 1, *strides], data_format),
+            padding="SAME",
+            data_format=data_format
+        )
+        return outputs
+
+
+def generator(style_gan, latents, quantizer=None, name="generator"):
+    # style_gan has to be built with a fixed growing_level=1.0 and switching_level=1.0
+    with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
+        with tf.contrib.framework.arg_scope([conv2d, conv2d_transpose], quantizer=quantizer):
+            with tf.contrib.framework.arg_scope([apply_noise], noise_mode="zero"):
+                latents = style_gan.mapping_network(latents)
+                return style_gan.systhesis_network(latents, latents)
+
+
+def quantize(style_gan, checkpoint, filename, num_latents=1024, batch_size=32,
+             latent_size=512, config=None, name="generator"):
+    ''' Calibrates activation ranges on random latents and writes the int8 artifact (.npz). '''
+    with tf.Graph().as_default():
+
+        tf.set_random_seed(0)
+
+        calibrator = Calibrator()
+        generator(style_gan, tf.random_normal([batch_size, latent_size]), calibrator, name)
+        variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=name)
+        saver = tf.train.Saver(variables)
+
+        with tf.Session(config=config) as session:
+
+            saver.restore(session, checkpoint)
+
+            ranges = [
+                session.run({
+                    layer_name: (layer.input_min, layer.input_max)
+                    for layer_name, layer in calibrator.layers.items()
+                })
+                for _ in range(num_latents // batch_size)
+            ]
+            values = dict(zip([variable.op.name for variable in variables], session.run(variables)))
+
+    artifact = {}
+    for layer_name, layer in calibrator.layers.items():
+        weight = effective_weight(values.pop(layer.weight.op.name), layer.variance_scale, layer.scale_weight)
+        # calibrated input range, averaged over the calibration batches
+        artifact["{}/input_min".format(layer_name)] = np.mean([batch_ranges[layer_name][0] for batch_ranges in ranges])
+        artifact["{}/input_max".format(layer_name)] = np.mean([batch_ranges[layer_name][1] for batch_ranges in ranges])
+        if layer.transpose:
+            # symmetric int8 per output channel
+            scale = np.maximum(np.max(np.abs(weight), axis=(0, 1, 2)), 1e-8) / 127
+            artifact["{}/weight_int8".format(layer_name)] = np.round(weight / scale).astype(np.int8)
+            artifact["{}/weight_scale".format(layer_name)] = scale.astype(np.float32)
+        else:
+            # asymmetric quint8 per tensor (as expected by quantized_conv2d)
+            weight_min, weight_max = np.min(weight), np.max(weight)
+            scale = np.maximum(weight_max - weight_min, 1e-8) / 255
+            artifact["{}/weight_quint8".format(layer_name)] = np.round((weight - weight_min) / scale).astype(np.uint8)
+            artifact["{}/weight_min".format(layer_name)] = weight_min
+            artifact["{}/weight_max".format(layer_name)] = weight_max
+    # remaining float variables
+    artifact.update(values)
+
+    np.savez(filename, **artifact)
+
+    return artifact
+
+
+class Int8Generator(object):
+
+    def __init__(self, style_gan, artifact, batch_size=None, latent_size=512, name="generator"):
+
+        self.latents = tf.placeholder(tf.float32, [batch_size, latent_size])
+        self.images = generator(style_gan, self.latents, Int8Convolutions(artifact), name)
+        self.variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=name)
+        self.artifact = artifact
+
+    def session(self, config=None):
+        session = tf.Session(config=config)
+        for variable in self.variables:
+            variable.load(self.artifact[variable.op.name], session)
+        return session
+
+
+def parameter_bytes(session, variables):
+    return sum(value.nbytes for value in session.run(variables))
+
+
+def constant_bytes(graph):
+    return sum(
+        len(op.get_attr("value").tensor_content)
+        for op in graph.get_operations() if op.type == "Const"
+    )
+
+
+def report(style_gan, checkpoint, artifact, real_input_fn=None, num_latents=4096, batch_sizes=[1, 32], num_steps=20,
+           latent_size=512, config=None, name="generator"):
+    ''' Parity and latency / parameter memory of both models at the given batch sizes.
+        Parity is the per-pixel error and FID between float and int8 samples of the same latents (a proxy),
+        with real_input_fn also FID(real, float), FID(real, int8) and their difference.
+        FID needs more samples (num_latents) than Inception features (2048) for full rank covariances.
+    '''
+    latents = np.random.RandomState(0).normal(size=[num_latents, latent_size]).astype(np.float32)
+    result = Struct()
+
+    def run(outputs, placeholder, session, inputs, batch_size):
+        return np.concatenate([
+            session.run(outputs, feed_dict={placeholder: inputs[begin:begin + batch_size]})
+            for begin in range(0, len(inputs), batch_size)
+        ])
+
+    def benchmark(images, placeholder, session, batch_size):
+        feed_dict = {placeholder: latents[:batch_size]}
+        session.run(images, feed_dict=feed_dict)
+        begin = time.perf_counter()
+        for _ in range(num_steps):
+            session.run(images, feed_dict=feed_dict)
+        return (time.perf_counter() - begin) / num_steps
+
+    # float32 reference
+    with tf.Graph().as_default() as graph:
+        placeholder = tf.placeholder(tf.float32, [None, latent_size])
+        images = generator(style_gan, placeholder, None, name)
+        variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=name)
+        with tf.Session(config=config) as session:
+            tf.train.Saver(variables).restore(session, checkpoint)
+            float_images = run(images, placeholder, session, latents, max(batch_sizes))
+            result.float_parameter_bytes = parameter_bytes(session, variables)
+            for batch_size in batch_sizes:
+                result["float_latency_{}".format(batch_size)] = benchmark(images, placeholder, session, batch_size)
+
+    # int8
+    with tf.Graph().as_default() as graph:
+        int8_generator = Int8Generator(style_gan, artifact, latent_size=latent_size, name=name)
+        with int8_generator.session(config) as session:
+            int8_images = run(int8_generator.images, int8_generator.latents, session, latents, max(batch_sizes))
+            result.int8_parameter_bytes = parameter_bytes(session, int8_generator.variables) + constant_bytes(graph)
+            for batch_size in batch_sizes:
+                result["int8_latency_{}".format(batch_size)] = benchmark(
+                    int8_generator.images, int8_generator.latents, session, batch_size
+                )
+
+    # parity
+    errors = np.abs(float_images - int8_images)
+    result.mean_pixel_error = np.mean(errors)
+    result.max_pixel_error = np.max(errors)
+
+    with tf.Graph().as_default():
+        placeholder = tf.placeholder(tf.float32, [None, *float_images.shape[1:]])
+        features = tf.contrib.gan.eval.run_inception(
+            images=tf.contrib.gan.eval.preprocess_image(tf.transpose(placeholder, [0, 2, 3, 1]) * 127.5 + 127.5),
+            output_tensor="pool_3:0"
+        )
+        real_images = real_input_fn() if real_input_fn else None
+        with tf.Session(config=config) as session:
+            float_features = run(features, placeholder, session, float_images, max(batch_sizes))
+            int8_features = run(features, placeholder, session, int8_images, max(batch_sizes))
+            if real_input_fn:
+                batches = []
+                while sum(map(len, batches)) < num_latents:
+                    try:
+                        batches.append(session.run(real_images))
+                    except tf.errors.OutOfRangeError:
+                        break
+                real_features = run(features, placeholder, session, np.concatenate(batches)[:num_latents], max(batch_sizes))
+    result.float_int8_frechet_inception_distance = metrics.frechet_inception_distance(float_features, int8_features)
+    if real_input_fn:
+        result.float_frechet_inception_distance = metrics.frechet_inception_distance(real_features, float_features)
+        result.int8_frechet_inception_distance = metrics.frechet_inception_distance(real_features, int8_features)
+        result.frechet_inception_distance_delta = result.int8_frechet_inception_distance - result.float_frechet_inception_distance
+
+    return result
@@ -0,0 +1,184 @@
+import tensorflow as tf
+import numpy as np
+import itertools
+import os
+from ops import apply_noise
+from hooks import load_generator_export
+
+
+def slerp(a, b, t):
+    # spherical interpolation (for Gaussian Z)
+    omega = np.arccos(np.clip(np.dot(a / np.linalg.norm(a), b / np.linalg.norm(b)), -1, 1))
+    if np.sin(omega) < 1e-6:
+        return (1 - t) * a + t * b
+    return (np.sin((1 - t) * omega) * a + np.sin(t * omega) * b) / np.sin(omega)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+class FrameWriter(object):
+    ''' Writes frames as numbered PNG files, encoded by encode_fn (e.g. Renderer.encode_png). '''
+
+    def __init__(self, directory, encode_fn):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.encode_fn = encode_fn
+        self.num_frames = 0
+
+    def __call__(self, frame):
+        with open(os.path.join(self.directory, "{:06d}.png".format(self.num_frames)), "wb") as file:
+            file.write(self.encode_fn(frame))
+        self.num_frames += 1
+
+    def close(self):
+        pass
+
+
+class VideoWriter(object):
+    ''' Writes frames to a video file, requires imageio (with ffmpeg). '''
+
+    def __init__(self, filename, fps=30):
+        import imageio
+        self.writer = imageio.get_writer(filename, fps=fps)
+
+    def __call__(self, frame):
+        self.writer.append_data(frame)
+
+    def close(self):
+        self.writer.close()
+
+
+class Renderer(object):
+    ''' Renders style-mixing grids and latent interpolations in batches.
+        Latents are mapped once and reused, each sample has its own crossover depth.
+        With noise_mode="seeded" the noise of every image is determined by its sample id.
+    '''
+
+    def __init__(self, style_gan, truncation=None, noise_mode="random", latent_size=512, name="generator"):
+
+        self.latents = tf.placeholder(tf.float32, [None, latent_size])
+        self.high_latents = tf.placeholder(tf.float32, [None, latent_size])
+        self.low_latents = tf.placeholder(tf.float32, [None, latent_size])
+        self.switching_depth = tf.placeholder(tf.int32, [None])
+        self.sample_ids = tf.placeholder(tf.int64, [None])
+
+        with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
+            self.mapped_latents = style_gan.mapping_network(self.latents)
+            with tf.contrib.framework.arg_scope([apply_noise], noise_mode=noise_mode, sample_ids=self.sample_ids):
+                images = style_gan.systhesis_network(
+                    high_level_latents=self.high_latents,
+                    low_level_latents=self.low_latents,
+                    truncation=truncation,
+                    switching_depth=self.switching_depth
+                )
+
+        images = tf.transpose(images, [0, 2, 3, 1])
+        images = tf.image.convert_image_dtype(images * 0.5 + 0.5, tf.uint8, saturate=True)
+
+        restored_variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=name)
+        if tf.train.get_global_step() is not None:
+            restored_variables.append(tf.train.get_global_step())
+
+        # grids and frames are assembled on the host and encoded by encode_png
+        self.image = tf.placeholder(tf.uint8, [None, None, 3])
+        self.png = tf.image.encode_png(self.image)
+
+        self.images = images
+        self.max_depth = style_gan.max_depth
+        self.name = name
+        self.restored_variables = restored_variables
+        self.saver = tf.train.Saver(restored_variables)
+        self.local_init_op = tf.local_variables_initializer()
+
+    def session(self, model_dir, config, generator_export=None):
+        ''' Restores the generator from the latest checkpoint, or from a (smaller) generator export. '''
+        session = tf.Session(config=config)
+        session.run(self.local_init_op)
+        if generator_export:
+            session.run(tf.variables_initializer(self.restored_variables))
+            load_generator_export(session, generator_export, scope=self.name)
+        else:
+            self.saver.restore(session, tf.train.latest_checkpoint(model_dir))
+        return session
+
+    def encode_png(self, session, image):
+        ''' Encodes an [height, width, 3] uint8 image as PNG. '''
+        return session.run(self.png, feed_dict={self.image: image})
+
+    def map(self, session, latents, batch_size):
+        return np.concatenate([
+            session.run(self.mapped_latents, feed_dict={self.latents: chunk})
+            for chunk in chunks(latents, batch_size)
+        ])
+
+    def synthesize(self, session, high_latents, low_latents, switching_depths, batch_size, sample_ids=None):
+        ''' Yields uint8 images batch by batch from mapped latents. '''
+        if sample_ids is None:
+            sample_ids = itertools.count()
+        for chunk in chunks(zip(high_latents, low_latents, switching_depths, sample_ids), batch_size):
+            high_latents, low_latents, switching_depths, sample_ids = map(np.array, zip(*chunk))
+            yield session.run(self.images, feed_dict={
+                self.high_latents: high_latents,
+                self.low_latents: low_latents,
+                self.switching_depth: switching_depths,
+                self.sample_ids: sample_ids
+            })
+
+    def style_mixing_grid(self, session, row_latents, column_latents, crossover_depths, batch_size):
+        ''' Image (i, j) takes the coarse styles (below the crossover depth) from row i
+            and the fine styles from column j. crossover_depths is a scalar or one depth per column.
+        '''
+        row_latents = self.map(session, row_latents, batch_size)
+        column_latents = self.map(session, column_latents, batch_size)
+        crossover_depths = np.broadcast_to(crossover_depths, [len(column_latents)])
+
+        rows, columns = np.meshgrid(np.arange(len(row_latents)), np.arange(len(column_latents)), indexing="ij")
+        images = np.concatenate(list(self.synthesize(
+            session=session,
+            high_latents=row_latents[rows.ravel()],
+            low_latents=column_latents[columns.ravel()],
+            switching_depths=crossover_depths[columns.ravel()],
+            batch_size=batch_size
+        )))
+
+        height, width, channels = images.shape[1:]
+        images = images.reshape(len(row_latents), len(column_latents), height, width, channels)
+        return images.transpose(0, 2, 1, 3, 4).reshape(len(row_latents) * height, len(column_latents) * width, channels)
+
+    def interpolate(self, session, keyframe_latents, num_frames, space, batch_size, writer):
+        ''' Streams a latent walk through keyframe_latents (num_frames per segment) to writer,
+            slerp in Z or lerp in W. Only one batch of frames is held in memory at a time.
+        '''
+        if space == "w":
+            keyframe_latents = self.map(session, keyframe_latents, batch_size)
+
+        def frame_latents():
+            for begin, end in zip(keyframe_latents[:-1], keyframe_latents[1:]):
+                for t in np.arange(num_frames) / num_frames:
+                    yield slerp(begin, end, t) if space == "z" else (1 - t) * begin + t * end
+            yield keyframe_latents[-1]
+
+        for chunk in chunks(frame_latents(), batch_size):
+            latents = np.array(chunk)
+            if space == "z":
+                latents = self.map(session, latents, batch_size)
+            # no style mixing, every layer uses the same latents
+            # and every frame the same sample id (seeded noise doesn't flicker)
+            for images in self.synthesize(
+                session=session,
+                high_latents=latents,
+                low_latents=latents,
+                switching_depths=[self.max_depth + 1] * len(latents),
+                batch_size=batch_size,
+                sample_ids=[0] * len(latents)
+            ):
+                for image in images:
+                    writer(image)
+        writer.close()
@@ -0,0 +1,154 @@
+import tensorflow as tf
+import numpy as np
+import http.server
+import threading
+import json
+import sys
+
+
+class Scorer(object):
+    ''' Scores images with the trained discriminator (higher logits = more realistic).
+        Only discriminator variables are restored, images are decoded by a parallel tf.data pipeline.
+        On CPU the style_gan has to be built with data_format="NHWC".
+        Images which can't be read or decoded are reported with a NaN logit.
+    '''
+
+    def __init__(self, style_gan, image_size, batch_size, group_size=4,
+                 num_parallel_calls=tf.data.experimental.AUTOTUNE, name="discriminator"):
+
+        # batch_stddev statistics are computed over groups of group_size images
+        if batch_size % group_size:
+            raise ValueError("batch_size ({}) has to be a multiple of group_size ({})".format(batch_size, group_size))
+
+        def pad(index, image):
+            return -tf.ones_like(index), image
+
+        def truncate(indices, images):
+            num_images = tf.shape(indices)[0] // group_size * group_size
+            return indices[:num_images], images[:num_images]
+
+        def decode(index, filename):
+            image = tf.read_file(filename)
+            image = tf.image.decode_image(image, 3, expand_animations=False)
+            image = tf.image.convert_image_dtype(image, tf.float32)
+            image = tf.image.resize_images(image, image_size)
+            image = tf.transpose(image, [2, 0, 1])
+            image = (image - 0.5) / 0.5
+            return index, image
+
+        self.filenames = tf.placeholder(tf.string, [None])
+
+        # images are tracked by index, so that the ones dropped by ignore_errors can be reported
+        dataset = tf.data.Dataset.from_tensor_slices((tf.range(tf.size(self.filenames)), self.filenames))
+        dataset = dataset.map(
+            map_func=decode,
+            num_parallel_calls=num_parallel_calls
+        )
+        dataset = dataset.apply(tf.data.experimental.ignore_errors())
+        # batch_stddev statistics of the last batch would be skewed by repeated images,
+        # so the stream is padded with group_size - 1 images from its beginning (index -1)
+        # and the last batch is truncated to a multiple of group_size (only padding is dropped)
+        dataset = dataset.concatenate(dataset.repeat().take(group_size - 1).map(pad))
+        dataset = dataset.batch(batch_size=batch_size)
+        dataset = dataset.map(truncate)
+        dataset = dataset.filter(lambda indices, images: tf.size(indices) > 0)
+        dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+        iterator = dataset.make_initializable_iterator()
+        indices, images = iterator.get_next()
+
+        logits = style_gan.discriminator(images, name=name)
+        logits = tf.squeeze(logits, axis=1)
+
+        restored_variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=name)
+        if tf.train.get_global_step() is not None:
+            restored_variables.append(tf.train.get_global_step())
+
+        self.initializer = iterator.initializer
+        self.indices = indices
+        self.logits = logits
+        self.saver = tf.train.Saver(restored_variables)
+        self.lock = threading.Lock()
+
+    def session(self, model_dir, config):
+        session = tf.Session(config=config)
+        self.saver.restore(session, tf.train.latest_checkpoint(model_dir))
+        return session
+
+    def score(self, session, filenames):
+        ''' Yields (filenames, logits) batch by batch, unreadable images last with NaN logits. '''
+        with self.lock:
+            session.run(self.initializer, feed_dict={self.filenames: filenames})
+            scored = np.zeros(len(filenames), bool)
+            while True:
+                try:
+                    indices, logits = session.run([self.indices, self.logits])
+                except tf.errors.OutOfRangeError:
+                    break
+                real = indices >= 0
+                scored[indices[real]] = True
+                yield [filenames[i] for i in indices[real]], logits[real]
+            failed = [filenames[i] for i in np.flatnonzero(~scored)]
+            if failed:
+                tf.logging.warning("couldn't read or decode {} images: {}".format(len(failed), failed))
+                yield failed, np.full(len(failed), np.nan, np.float32)
+
+    def score_files(self, session, filenames, output_filename):
+        with open(output_filename, "w") as file:
+            for batch_filenames, logits in self.score(session, filenames):
+                for filename, logit in zip(batch_filenames, logits):
+                    file.write("{}\t{}\n".format(filename, logit))
+
+    def serve_stdio(self, session, chunk_size=1024):
+        ''' Reads one path per line from stdin and writes "path<TAB>logit" lines to stdout. '''
+        def chunks():
+            chunk = []
+            for line in sys.stdin:
+                if not line.strip():
+                    continue
+                chunk.append(line.strip())
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        for chunk in chunks():
+            for batch_filenames, logits in self.score(session, chunk):
+                for filename, logit in zip(batch_filenames, logits):
+                    sys.stdout.write("{}\t{}\n".format(filename, logit))
+                sys.stdout.flush()
+
+    def serve_http(self, session, host, port, max_body_size=1 << 20):
+        ''' POST newline separated paths, responds with a json object {path: logit} (null if unreadable).
+            Requests need a Content-Length of at most max_body_size bytes.
+        '''
+        scorer = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                try:
+                    content_length = int(self.headers["Content-Length"])
+                except (TypeError, ValueError):
+                    self.send_error(411)
+                    return
+                if not 0 <= content_length <= max_body_size:
+                    self.send_error(413)
+                    return
+                body = self.rfile.read(content_length).decode()
+                filenames = [line.strip() for line in body.splitlines() if line.strip()]
+                scores = {
+                    filename: None if np.isnan(logit) else float(logit)
+                    for batch_filenames, logits in scorer.score(session, filenames)
+                    for filename, logit in zip(batch_filenames, logits)
+                }
+                response = json.dumps(scores).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+        tf.logging.info("serving discriminator scores on {}:{}".format(host, port))
+        http.server.ThreadingHTTPServer((host, port), Handler).serve_forever()
@@ -0,0 +1,185 @@
+#=================================================================================================#
+# Hyperparameter sweep by successive halving
+# [Non-stochastic Best Arm Identification and Hyperparameter Optimization]
+# (https://arxiv.org/pdf/1502.07943.pdf)
+#=================================================================================================#
+
+import tensorflow as tf
+import numpy as np
+import concurrent.futures
+import argparse
+import subprocess
+import itertools
+import csv
+import sys
+import os
+from dataset import convert_celeba
+from utils import Struct
+
+# main.py arguments and their candidate values
+SEARCH_SPACE = Struct(
+    generator_learning_rate=[5e-4, 1e-3, 2e-3, 4e-3],
+    discriminator_learning_rate=[5e-4, 1e-3, 2e-3, 4e-3],
+    generator_beta2=[0.9, 0.99],
+    discriminator_beta2=[0.9, 0.99],
+    real_gradient_penalty_weight=[1.0, 5.0, 10.0],
+    max_channels=[128, 256, 512],
+    mapping_layers=[4, 8]
+)
+
+
+def sample_configs(search_space, num_configs, seed=0):
+    ''' Distinct random configs (all of them if the search space is smaller than num_configs). '''
+    random = np.random.RandomState(seed)
+    configs = [dict(zip(search_space.keys(), values)) for values in itertools.product(*search_space.values())]
+    return [configs[i] for i in random.permutation(len(configs))[:num_configs]]
+
+
+class Trial(object):
+    ''' One config trained (and resumed) in its own model_dir by main.py subprocesses. '''
+
+    def __init__(self, name, config, model_dir):
+        self.name = name
+        self.config = config
+        self.model_dir = model_dir
+        self.scores = {}
+        self.failures = {}
+
+    def arguments(self):
+        return ["--model_dir", self.model_dir] + [
+            argument for name, value in self.config.items()
+            for argument in ["--{}".format(name), str(value)]
+        ]
+
+    def run(self, common_arguments, train_steps, eval_steps, num_threads):
+        ''' Returns the FID after train_steps, or None if a subprocess failed (recorded in failures). '''
+        # CPU only, every process gets its own slice of the cores
+        environment = dict(os.environ, CUDA_VISIBLE_DEVICES="", OMP_NUM_THREADS=str(num_threads))
+        command = [
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+            *common_arguments, *self.arguments(),
+            "--intra_op_threads", str(num_threads),
+            "--inter_op_threads", "2"
+        ]
+        with open(os.path.join(self.model_dir, "log.txt"), "a") as log:
+            for mode in [["--train", "--train_steps", str(train_steps)], ["--evaluate", "--eval_steps", str(eval_steps)]]:
+                process = subprocess.run(command + mode, env=environment, stdout=log, stderr=subprocess.STDOUT)
+                if process.returncode:
+                    self.failures[train_steps] = "{} exited with {}, see {}".format(mode[0], process.returncode, log.name)
+                    tf.logging.error("{}: {}".format(self.name, self.failures[train_steps]))
+                    return None
+
+        with open(os.path.join(self.model_dir, "eval", "results.csv")) as file:
+            row = list(csv.DictReader(file))[-1]
+        self.scores[train_steps] = float(row["frechet_inception_distance"])
+        return self.scores[train_steps]
+
+
+def successive_halving(trials, common_arguments, min_steps, num_rungs, reduction_factor,
+                       eval_steps, num_processes, num_threads):
+    ''' Trains all trials for min_steps, keeps the best 1 / reduction_factor by FID,
+        resumes them for reduction_factor times more steps and so on for num_rungs rungs.
+        Trials whose subprocesses fail are not ranked, they are dropped and reported separately.
+    '''
+    for rung in range(num_rungs):
+
+        train_steps = min_steps * reduction_factor ** rung
+
+        with concurrent.futures.ThreadPoolExecutor(num_processes) as executor:
+            scores = list(executor.map(
+                lambda trial: trial.run(common_arguments, train_steps, eval_steps, num_threads),
+                trials
+            ))
+
+        failed_trials = [trial for trial, score in zip(trials, scores) if score is None]
+        if failed_trials:
+            tf.logging.error("rung {} ({} steps): {} trials failed: {}".format(
+                rung, train_steps, len(failed_trials), ", ".join(trial.name for trial in failed_trials)
+            ))
+        scored = [(score, i) for i, score in enumerate(scores) if score is not None]
+        if not scored:
+            raise RuntimeError("every trial of rung {} failed".format(rung))
+
+        trials = [trials[i] for _, i in sorted(scored)]
+        for trial in trials:
+            tf.logging.info("rung {} ({} steps) {}: FID = {} {}".format(
+                rung, train_steps, trial.name, trial.scores.get(train_steps), trial.config
+            ))
+
+        if rung < num_rungs - 1:
+            # dominated configs are not trained any further
+            trials = trials[:max(len(trials) // reduction_factor, 1)]
+
+    # best first
+    return trials
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep_dir", type=str, default="celeba_style_gan_sweep")
+    parser.add_argument('--filenames', type=str, nargs="+", default=["celeba_train.tfrecord"])
+    parser.add_argument("--resolution", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--input_memmap", type=str, default=None)
+    parser.add_argument("--num_configs", type=int, default=27)
+    parser.add_argument("--min_steps", type=int, default=1000)
+    parser.add_argument("--num_rungs", type=int, default=3)
+    parser.add_argument("--reduction_factor", type=int, default=3)
+    parser.add_argument("--eval_steps", type=int, default=256)
+    parser.add_argument("--num_processes", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # FID needs more samples than Inception features (2048) for full rank covariances
+    if args.eval_steps * args.batch_size < 2048:
+        parser.error("--eval_steps * --batch_size ({}) has to be at least 2048".format(args.eval_steps * args.batch_size))
+
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    # one pre-decoded copy of the dataset in shared memory, read through the page cache by every run
+    input_memmap = args.input_memmap or "/dev/shm/celeba_{}.uint8map".format(args.resolution)
+    if not os.path.exists(input_memmap):
+        convert_celeba(args.filenames, [args.resolution, args.resolution], input_memmap)
+
+    # growing finishes within the budget of the last rung
+    total_steps = args.min_steps * args.reduction_factor ** (args.num_rungs - 1)
+    common_arguments = [
+        "--filenames", *args.filenames,
+        "--resolution", str(args.resolution),
+        "--batch_size", str(args.batch_size),
+        "--total_steps", str(total_steps),
+        "--save_checkpoint_steps", str(total_steps),
+        "--input_memmap", input_memmap,
+        # stock CPU kernels don't support NCHW convolutions and pools
+        "--data_format", "NHWC",
+        "--gpu", ""
+    ]
+
+    trials = []
+    for i, config in enumerate(sample_configs(SEARCH_SPACE, args.num_configs, args.seed)):
+        trial = Trial("trial_{}".format(i), config, os.path.join(args.sweep_dir, "trial_{}".format(i)))
+        os.makedirs(trial.model_dir, exist_ok=True)
+        trials.append(trial)
+
+    survivors = successive_halving(
+        trials=trials,
+        common_arguments=common_arguments,
+        min_steps=args.min_steps,
+        num_rungs=args.num_rungs,
+        reduction_factor=args.reduction_factor,
+        eval_steps=args.eval_steps,
+        num_processes=args.num_processes,
+        num_threads=max(os.cpu_count() // args.num_processes, 1)
+    )
+
+    with open(os.path.join(args.sweep_dir, "sweep.csv"), "w") as file:
+        writer = csv.DictWriter(file, fieldnames=["trial", *SEARCH_SPACE.keys(), "train_steps", "frechet_inception_distance", "failure"])
+        writer.writeheader()
+        for trial in trials:
+            for train_steps, score in trial.scores.items():
+                writer.writerow(dict(trial=trial.name, **trial.config, train_steps=train_steps, frechet_inception_distance=score))
+            for train_steps, failure in trial.failures.items():
+                writer.writerow(dict(trial=trial.name, **trial.config, train_steps=train_steps, failure=failure))
+
+    tf.logging.info("best config: {} {}".format(survivors[0].name, survivors[0].config))
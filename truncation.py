@@ -0,0 +1,69 @@
+import tensorflow as tf
+import numpy as np
+import os
+from hooks import load_generator_export
+
+
+def average_latents_filename(checkpoint):
+    return "{}.average_latents.npy".format(checkpoint)
+
+
+def estimate_average_latents(style_gan, checkpoint, num_samples, batch_size,
+                             latent_size=512, config=None, name="generator"):
+    ''' Streams num_samples latents through the mapping network in batches
+        and returns the mean mapped latent (the W-space centroid).
+        checkpoint can also be a generator export (.npz) of AsyncCheckpointSaverHook.
+    '''
+    with tf.Graph().as_default():
+
+        with tf.variable_scope(name):
+            latents = style_gan.mapping_network(tf.random_normal([batch_size, latent_size]))
+        sum_latents = tf.reduce_sum(tf.cast(latents, tf.float64), axis=0)
+
+        saver = tf.train.Saver(tf.get_collection(
+            key=tf.GraphKeys.GLOBAL_VARIABLES,
+            scope="{}/mapping_network".format(name)
+        ))
+
+        with tf.Session(config=config) as session:
+
+            if checkpoint.endswith(".npz"):
+                session.run(tf.global_variables_initializer())
+                load_generator_export(session, checkpoint, scope=name)
+            else:
+                saver.restore(session, checkpoint)
+
+            num_batches = (num_samples + batch_size - 1) // batch_size
+            average_latents = sum(session.run(sum_latents) for _ in range(num_batches))
+            average_latents /= num_batches * batch_size
+
+    return average_latents.astype(np.float32)
+
+
+def load_average_latents(style_gan, model_dir, num_samples=100000, batch_size=1000,
+                         latent_size=512, config=None, name="generator", generator_export=None):
+    ''' Returns the W-space centroid of the latest checkpoint in model_dir (or of generator_export).
+        It is estimated once and persisted next to the checkpoint, later calls just load it.
+    '''
+    checkpoint = generator_export or tf.train.latest_checkpoint(model_dir)
+    filename = average_latents_filename(checkpoint)
+
+    if os.path.exists(filename):
+        return np.load(filename)
+
+    tf.logging.info("estimating average latents of {} from {} samples".format(checkpoint, num_samples))
+    average_latents = estimate_average_latents(
+        style_gan=style_gan,
+        checkpoint=checkpoint,
+        num_samples=num_samples,
+        batch_size=batch_size,
+        latent_size=latent_size,
+        config=config,
+        name=name
+    )
+
+    with open("{}.tmp".format(filename), "wb") as file:
+        np.save(file, average_latents)
+    os.replace(file.name, filename)
+
+    return average_latents